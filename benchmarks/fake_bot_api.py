@@ -0,0 +1,53 @@
+from aiohttp import web
+import collections
+import asyncio
+import random
+import time
+
+"""
+In-process stand-in for api.telegram.org
+Records every call (time, method, chat_id, text), can add latency and answer part of calls with 429
+"""
+
+Call = collections.namedtuple('Call', 'time method chat_id text')
+
+
+class FakeBotApi:
+    def __init__(self, latency: float = 0, rate_limit_share: float = 0, retry_after: int = 1):
+        self.latency = latency  # seconds before answer
+        self.rate_limit_share = rate_limit_share    # share of calls answered with 429
+        self.retry_after = retry_after
+        self.calls = []
+        self.rate_limited = 0
+        self.app = web.Application()
+        self.app.add_routes([web.post('/{bot}/{method}', self.handle)])
+
+    async def handle(self, request: web.Request) -> web.Response:
+        payload = await request.json()
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if random.random() < self.rate_limit_share:
+            self.rate_limited += 1
+            return web.json_response({'ok': False,
+                                      'error_code': 429,
+                                      'description': f'Too Many Requests: retry after {self.retry_after}',
+                                      'parameters': {'retry_after': self.retry_after}},
+                                     status=429)
+        self.calls.append(Call(time.monotonic(),
+                               request.match_info['method'],
+                               payload.get('chat_id'),
+                               payload.get('text') or payload.get('caption')))
+        return web.json_response({'ok': True,
+                                  'result': {'message_id': len(self.calls),
+                                             'chat': {'id': payload.get('chat_id')},
+                                             'date': int(time.time())}})
+
+    def replies(self) -> dict:  # chat_id: [Call] in order of receiving
+        replies = collections.defaultdict(list)
+        for call in self.calls:
+            replies[call.chat_id].append(call)
+        return replies
+
+
+if __name__ == '__main__':     # python benchmarks/fake_bot_api.py: standalone server on port 8081
+    web.run_app(FakeBotApi().app, host='127.0.0.1', port=8081)
@@ -0,0 +1,197 @@
+import sys
+import time
+import random
+import asyncio
+import argparse
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'source'))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+from aiohttp import web  # noqa: E402
+import aiohttp  # noqa: E402
+from main import create_app, read_config  # noqa: E402
+from fake_bot_api import FakeBotApi  # noqa: E402
+
+"""
+Load test of webhook against local PostgreSQL (database of config.ini in current directory is used)
+python benchmarks/load_test.py --chats 200 --rate 100
+Bot application and fake Bot API run in this process, synthetic updates are posted at target rate:
+registration conversations (callbacks and texts, replies must come in order of steps)
+and media conversations (command, photo, document), with part of updates delivered out of order or twice.
+Report: ack latency, end-to-end reply latency, throughput, lost and extra replies, ordering violations
+"""
+
+REGISTRATION_REPLIES = ('Регистрация. Шаг 1',
+                        'Регистрация. Шаг 2',
+                        'Регистрация. Шаг 3',
+                        'Регистрация. Шаг 4',
+                        'Регистрация прошла успешно')
+HELP_REPLY = 'Выберите действие'
+
+
+def sender(chat_id: int) -> dict:
+    return {'id': chat_id, 'is_bot': False, 'first_name': 'Bench'}
+
+
+def callback(chat_id: int, value: str) -> dict:
+    return {'callback_query': {'id': str(random.getrandbits(48)), 'from': sender(chat_id),
+                               'chat_instance': str(chat_id), 'data': value}}
+
+
+def message(chat_id: int, **content) -> dict:
+    return {'message': dict({'message_id': random.getrandbits(31), 'from': sender(chat_id),
+                             'chat': {'id': chat_id, 'type': 'private'}, 'date': int(time.time())}, **content)}
+
+
+def registration(chat_id: int) -> list:   # (update without update_id, expected reply)
+    return list(zip([callback(chat_id, '/register'),
+                     callback(chat_id, 'student'),
+                     message(chat_id, text='Bench'),
+                     message(chat_id, text='Mark'),
+                     message(chat_id, text='+79210000000')],
+                    REGISTRATION_REPLIES))
+
+
+def media(chat_id: int) -> list:
+    file = f'bench{chat_id}'
+    return [(message(chat_id, text='/help'), HELP_REPLY),
+            (message(chat_id, photo=[{'file_id': f'{file}p', 'file_unique_id': f'{file}p', 'file_size': 1000,
+                                      'width': 90, 'height': 60}], caption='homework'), HELP_REPLY),
+            (message(chat_id, document={'file_id': f'{file}d', 'file_unique_id': f'{file}d', 'file_size': 5000,
+                                        'mime_type': 'application/pdf'}), HELP_REPLY)]
+
+
+def percentile(values: list, share: float) -> float:
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(int(share * len(values)), len(values) - 1)]
+
+
+class LoadTest:
+    def __init__(self, args: argparse.Namespace):
+        self.args = args
+        self.sent = {}  # chat_id: {update_id: first delivery time}
+        self.expected = {}  # chat_id: expected replies in order
+        self.acks = []  # ack latencies of deliveries with 200 status
+        self.refused = 0    # deliveries with other statuses
+
+    # Deliveries in order of sending: lists of updates posted one after another in one slot
+    def plan(self) -> list:
+        update_id = time.time_ns() // 1000
+        chat_base = int(time.time()) * 1000
+        conversations = {}
+        for number in range(self.args.chats):
+            chat_id = chat_base + number
+            scenario = media if random.random() < self.args.media_share else registration
+            updates = []
+            self.expected[chat_id] = []
+            for json_update, reply in scenario(chat_id):
+                update_id += 1
+                updates.append(dict(json_update, update_id=update_id))
+                self.expected[chat_id].append(reply)
+            conversations[chat_id] = updates
+        deliveries = []
+        while conversations:
+            for chat_id in list(conversations):
+                updates = conversations[chat_id]
+                if len(updates) > 1 and random.random() < self.args.reorder_share:
+                    delivery = [updates[1], updates[0]]     # later update comes first
+                else:
+                    delivery = updates[:1]
+                del updates[:len(delivery)]
+                if random.random() < self.args.duplicate_share:
+                    delivery.append(delivery[0])    # Telegram repeats update
+                deliveries.append(delivery)
+                if not updates:
+                    del conversations[chat_id]
+        return deliveries
+
+    # Refused update is delivered again after a pause, as Telegram does
+    async def deliver(self, session: aiohttp.ClientSession, delivery: list):
+        for json_update in delivery:
+            chat_id = (json_update.get('message') or json_update['callback_query'])['from']['id']
+            for attempt in range(self.args.attempts):
+                started = time.monotonic()
+                self.sent.setdefault(chat_id, {}).setdefault(json_update['update_id'], started)
+                async with session.post(f'http://127.0.0.1:{self.args.port}/', json=json_update) as response:
+                    await response.read()
+                    if response.status == 200:
+                        self.acks.append(time.monotonic() - started)
+                        break
+                    self.refused += 1
+                await asyncio.sleep(self.args.redelivery_delay)
+
+    async def run(self):
+        random.seed(self.args.seed)
+        api = FakeBotApi(self.args.api_latency, self.args.api_429_share)
+        api_runner = web.AppRunner(api.app)
+        await api_runner.setup()
+        await web.TCPSite(api_runner, '127.0.0.1', self.args.api_port).start()
+        config = read_config()
+        config.set('Bot', 'server_url', f'http://127.0.0.1:{self.args.api_port}/')
+        config.set('Bot', 'bot_token', 'bench')
+        bot_runner = web.AppRunner(create_app(config))
+        await bot_runner.setup()
+        await web.TCPSite(bot_runner, '127.0.0.1', self.args.port).start()
+        deliveries = self.plan()
+        expected_replies = sum(len(replies) for replies in self.expected.values())
+        try:
+            async with aiohttp.ClientSession() as session:
+                started = time.monotonic()
+                tasks = []
+                for number, delivery in enumerate(deliveries):
+                    await asyncio.sleep(max(started + number / self.args.rate - time.monotonic(), 0))
+                    tasks.append(asyncio.create_task(self.deliver(session, delivery)))
+                await asyncio.gather(*tasks)
+                sending_time = time.monotonic() - started
+            deadline = time.monotonic() + self.args.timeout
+            while len(api.calls) < expected_replies and time.monotonic() < deadline:
+                await asyncio.sleep(0.1)
+        finally:
+            await bot_runner.cleanup()
+            await api_runner.cleanup()
+        self.report(api, started, sending_time)
+
+    def report(self, api: FakeBotApi, started: float, sending_time: float):
+        replies = api.replies()
+        latencies = []
+        lost = extra = violations = 0
+        for chat_id, expected in self.expected.items():
+            received = replies.get(chat_id, [])
+            lost += max(len(expected) - len(received), 0)
+            extra += max(len(received) - len(expected), 0)
+            sent_times = [sent_time for update_id, sent_time in sorted(self.sent.get(chat_id, {}).items())]
+            for number, (reply, call) in enumerate(zip(expected, received)):
+                if reply not in (call.text or ''):
+                    violations += 1
+                if number < len(sent_times):
+                    latencies.append(call.time - sent_times[number])
+        calls_time = (api.calls[-1].time - started) if api.calls else 0
+        print(f'updates accepted: {len(self.acks)} in {sending_time:.1f} s ({len(self.acks) / sending_time:.0f}/s), '
+              f'refused (non-200): {self.refused}')
+        print(f'ack latency, ms: p50 {percentile(self.acks, 0.5) * 1000:.1f}, '
+              f'p95 {percentile(self.acks, 0.95) * 1000:.1f}, p99 {percentile(self.acks, 0.99) * 1000:.1f}')
+        print(f'reply latency, ms: p50 {percentile(latencies, 0.5) * 1000:.1f}, '
+              f'p95 {percentile(latencies, 0.95) * 1000:.1f}, p99 {percentile(latencies, 0.99) * 1000:.1f}')
+        print(f'replies: {len(api.calls)} ({len(api.calls) / calls_time if calls_time else 0:.0f}/s), '
+              f'lost {lost}, extra {extra}, ordering violations {violations}, 429 answered {api.rate_limited}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--chats', type=int, default=200)
+    parser.add_argument('--rate', type=float, default=100, help='deliveries per second')
+    parser.add_argument('--media-share', type=float, default=0.3)
+    parser.add_argument('--reorder-share', type=float, default=0.1)
+    parser.add_argument('--duplicate-share', type=float, default=0.05)
+    parser.add_argument('--api-latency', type=float, default=0.05, help='seconds')
+    parser.add_argument('--api-429-share', type=float, default=0.0)
+    parser.add_argument('--attempts', type=int, default=5, help='deliveries of refused update')
+    parser.add_argument('--redelivery-delay', type=float, default=1, help='seconds')
+    parser.add_argument('--timeout', type=float, default=60, help='seconds to wait for replies')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--api-port', type=int, default=8081)
+    parser.add_argument('--seed', type=int, default=1)
+    asyncio.run(LoadTest(parser.parse_args()).run())
@@ -0,0 +1,66 @@
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'source'))
+
+from data import parse_update  # noqa: E402
+
+"""
+Microbenchmark of updates parsing
+python benchmarks/parse_updates.py [number of updates]
+Prints parse throughput and memory held by parsed Update objects (with their Data) per update
+"""
+
+SENDER = {'id': 123456789, 'is_bot': False, 'first_name': 'Ivan', 'language_code': 'ru'}
+CHAT = {'id': 123456789, 'first_name': 'Ivan', 'type': 'private'}
+
+UPDATES = {
+    'text': {'update_id': 1,
+             'message': {'message_id': 10, 'from': SENDER, 'chat': CHAT, 'date': 1660000000,
+                         'text': 'Домашнее задание на понедельник'}},
+    'command': {'update_id': 2,
+                'message': {'message_id': 11, 'from': SENDER, 'chat': CHAT, 'date': 1660000000,
+                            'text': '/register', 'entities': [{'offset': 0, 'length': 9, 'type': 'bot_command'}]}},
+    'photo': {'update_id': 3,
+              'message': {'message_id': 12, 'from': SENDER, 'chat': CHAT, 'date': 1660000000,
+                          'photo': [{'file_id': f'AgACAgIAAxkBAAIBsmL{size}', 'file_unique_id': f'AQADsmL{size}',
+                                     'file_size': 1000 * size, 'width': 90 * size, 'height': 60 * size}
+                                    for size in range(1, 4)],
+                          'caption': 'Задача 5'}},
+    'document': {'update_id': 4,
+                 'message': {'message_id': 13, 'from': SENDER, 'chat': CHAT, 'date': 1660000000,
+                             'document': {'file_name': 'worksheet.pdf', 'mime_type': 'application/pdf',
+                                          'file_id': 'BQACAgIAAxkBAAIBs2L', 'file_unique_id': 'AgADs2L',
+                                          'file_size': 48213}}},
+    'callback_query': {'update_id': 5,
+                       'callback_query': {'id': '4382bfdwdsb323b2d9', 'from': SENDER,
+                                          'message': {'message_id': 14, 'chat': CHAT, 'date': 1660000000,
+                                                      'text': 'Выберите действие:'},
+                                          'chat_instance': '-8242423489', 'data': '/help'}},
+}
+
+
+def throughput(json_update: dict, number: int) -> float:
+    started = time.perf_counter()
+    for _ in range(number):
+        parse_update(json_update)
+    return number / (time.perf_counter() - started)
+
+
+def bytes_per_update(json_update: dict, number: int) -> float:
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    updates = [parse_update(json_update) for _ in range(number)]
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    size = sum(stat.size_diff for stat in after.compare_to(before, 'filename'))
+    return (size - sys.getsizeof(updates)) / len(updates)
+
+
+if __name__ == '__main__':
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    print(f'{"type":<16}{"updates/s":>12}{"bytes/update":>14}')
+    for name, json_update in UPDATES.items():
+        print(f'{name:<16}{throughput(json_update, number):>12.0f}{bytes_per_update(json_update, number // 10):>14.0f}')
@@ -0,0 +1,156 @@
+from customconfigparser import CustomConfigParser
+import metrics
+import logging
+import asyncio
+import time
+
+logger = logging.getLogger(__name__)
+
+# Load levels of webhook
+NORMAL = 0
+DEGRADED = 1    # only updates of known users are accepted
+OVERLOADED = 2  # all updates are refused, Telegram will repeat them later
+
+"""
+Admission control of webhook
+Load level is estimated by backlog of updates tasks, updates waiting for handler slot of limiter,
+waiting time for pool connection and event loop lag; refused updates are counted by reason
+"""
+
+
+class AdmissionControl:
+    def __init__(self,
+                 database: object,
+                 background_tasks: set,
+                 limiter: object,
+                 soft_backlog: int = None,
+                 max_backlog: int = None,
+                 max_handler_queue: int = None,
+                 max_pool_wait: float = None,
+                 max_loop_lag: float = None,
+                 lag_interval: float = None,
+                 config: CustomConfigParser = None):
+
+        self.__database = database
+        self.__background_tasks = background_tasks
+        self.__limiter = limiter
+        if not soft_backlog:
+            self.__soft_backlog = int(config.get('Admission', 'soft_backlog'))
+        else:
+            self.__soft_backlog = soft_backlog
+        if not max_backlog:
+            self.__max_backlog = int(config.get('Admission', 'max_backlog'))
+        else:
+            self.__max_backlog = max_backlog
+        if not max_handler_queue:
+            self.__max_handler_queue = int(config.get('Admission', 'max_handler_queue'))
+        else:
+            self.__max_handler_queue = max_handler_queue
+        if not max_pool_wait:
+            self.__max_pool_wait = float(config.get('Admission', 'max_pool_wait'))
+        else:
+            self.__max_pool_wait = max_pool_wait
+        if not max_loop_lag:
+            self.__max_loop_lag = float(config.get('Admission', 'max_loop_lag'))
+        else:
+            self.__max_loop_lag = max_loop_lag
+        if not lag_interval:
+            self.__lag_interval = float(config.get('Admission', 'lag_interval'))
+        else:
+            self.__lag_interval = lag_interval
+        self.__loop_lag = 0
+        self.__level = NORMAL
+        self.__accepted = 0
+        self.__shed = {}    # reason: number of refused updates
+        self.__task = None
+
+    @property
+    def soft_backlog(self) -> int:
+        return self.__soft_backlog
+
+    @property
+    def max_backlog(self) -> int:
+        return self.__max_backlog
+
+    @property
+    def max_handler_queue(self) -> int:
+        return self.__max_handler_queue
+
+    @property
+    def max_pool_wait(self) -> float:
+        return self.__max_pool_wait
+
+    @property
+    def max_loop_lag(self) -> float:
+        return self.__max_loop_lag
+
+    @property
+    def lag_interval(self) -> float:
+        return self.__lag_interval
+
+    @property
+    def backlog(self) -> int:
+        return len(self.__background_tasks)
+
+    @property
+    def loop_lag(self) -> float:
+        return self.__loop_lag
+
+    @property
+    def accepted(self) -> int:
+        return self.__accepted
+
+    @property
+    def shed(self) -> dict:
+        return dict(self.__shed)
+
+    def level(self) -> int:
+        if self.backlog >= self.max_backlog:
+            level = OVERLOADED
+        elif (self.backlog >= self.soft_backlog or
+              self.__limiter.waiting >= self.max_handler_queue or
+              self.__database.pool_wait >= self.max_pool_wait or
+              self.loop_lag >= self.max_loop_lag):
+            level = DEGRADED
+        else:
+            level = NORMAL
+        if level != self.__level:
+            logger.warning('Load level %s -> %s (backlog %s, handler queue %s, pool wait %.3f, loop lag %.3f)',
+                           self.__level, level, self.backlog, self.__limiter.waiting,
+                           self.__database.pool_wait, self.loop_lag)
+            self.__level = level
+        return level
+
+    def accept(self):
+        self.__accepted += 1
+
+    def refuse(self, reason: str):
+        self.__shed[reason] = self.__shed.get(reason, 0) + 1
+
+    # Event loop lag is measured as delay of waking up after sleeping lag_interval,
+    # peaks decay slowly, so level doesn't flap between measurements
+    async def measure_loop_lag(self):
+        while True:
+            started = time.monotonic()
+            await asyncio.sleep(self.lag_interval)
+            lag = max(time.monotonic() - started - self.lag_interval, 0)
+            metrics.LOOP_LAG.observe(lag)
+            self.__loop_lag = max(lag, 0.9 * self.__loop_lag)
+
+    async def start(self):
+        self.__task = asyncio.create_task(self.measure_loop_lag())
+
+    async def close(self):
+        if self.__task:
+            self.__task.cancel()
+            await asyncio.gather(self.__task, return_exceptions=True)
+
+
+# aiohttp application signals
+
+async def start_admission(app):
+    await app['admission'].start()
+
+
+async def close_admission(app):
+    await app['admission'].close()
@@ -0,0 +1,148 @@
+from customconfigparser import CustomConfigParser
+from data import Text, Photo, Document
+from view import SendMessage, SendPhoto, SendDocument, SendData
+from dispatcher import BULK
+import statements
+import logging
+import asyncio
+import uuid
+
+logger = logging.getLogger(__name__)
+
+# NOTIFY channel of created broadcasts, payload is broadcast_id
+BROADCASTS_CHANNEL = 'broadcasts_added'
+
+"""
+Fan-out of one message to audience: all students, one family (parent and children) or students of lesson
+Recipients are resolved by create_broadcast() database function in one query and stored with status,
+then claimed by batches in transactions that write their messages to outbox with bulk priority,
+so every message is sent by the worker of its chat and interactive replies go first.
+Broadcast is created in transaction of update handling and sent after commit (by notification),
+unfinished broadcasts are resumed at start
+"""
+
+
+class Broadcaster:
+    audiences = ('students', 'family', 'lesson')
+
+    def __init__(self,
+                 database: object,
+                 outbox: object,
+                 media: object,
+                 batch_size: int = None,
+                 config: CustomConfigParser = None):
+
+        self.__database = database
+        self.__outbox = outbox
+        self.__media = media    # MediaRegistry
+        self.__config = config  # for messages to send
+        if not batch_size:
+            self.__batch_size = int(config.get('Broadcasts', 'batch_size'))
+        else:
+            self.__batch_size = batch_size
+        self.__tasks = {}   # broadcast_id: task
+        self.__listener_task = None
+
+    @property
+    def batch_size(self) -> int:
+        return self.__batch_size
+
+    # Returns broadcast_id, file_type is photo or document. Must be called in transaction of update handling.
+    # File received by bot before (homework worksheet...) can be given by file_unique_id instead of file_id
+    async def broadcast(self,
+                        connection: object,
+                        author_id: uuid.UUID,
+                        text: str,
+                        audience: str,
+                        audience_id=None,
+                        file_type: str = None,
+                        file_id: str = None,
+                        file_unique_id: str = None) -> int:
+        if audience not in self.audiences:
+            raise ValueError(f'Audience should be one of {", ".join(self.audiences)}')
+        if file_type not in (None, 'photo', 'document'):
+            raise ValueError('File type should be photo or document')
+        if file_unique_id:
+            file_id = await self.__media.file_id(connection, file_unique_id)
+            if file_id is None:
+                raise ValueError(f'File {file_unique_id} is unknown')
+        return await statements.CREATE_BROADCAST.fetchval(connection,
+                                                          author_id,
+                                                          text,
+                                                          file_type,
+                                                          file_id,
+                                                          audience,
+                                                          None if audience_id is None else str(audience_id))
+
+    def __message(self, broadcast: dict, chat_id: int) -> SendData:
+        if broadcast['file_type'] == 'photo':
+            return SendPhoto(self.__config, chat_id, Photo(broadcast['file_id'], caption=broadcast['text']))
+        if broadcast['file_type'] == 'document':
+            return SendDocument(self.__config, chat_id, Document(broadcast['file_id'], caption=broadcast['text']))
+        return SendMessage(self.__config, chat_id, Text(broadcast['text']))
+
+    # Batch is queued with its outbox rows or not at all, so interrupted or crashed sending loses nothing
+    async def send(self, broadcast_id: int):
+        async with self.__database.acquire() as connection:
+            broadcast = await statements.BROADCAST.fetchrow(connection, broadcast_id)
+        while True:
+            async with self.__database.acquire() as connection:
+                async with connection.transaction():
+                    recipients = await statements.CLAIM_RECIPIENTS.fetch(connection, broadcast_id, self.batch_size)
+                    await self.__outbox.put_many(connection,
+                                                 [self.__message(broadcast, recipient['chat_id'])
+                                                  for recipient in recipients],
+                                                 BULK)
+            if not recipients:
+                break
+        async with self.__database.acquire() as connection:
+            await statements.FINISH_BROADCAST.execute(connection, broadcast_id)
+
+    async def __send_logged(self, broadcast_id: int):
+        try:
+            await self.send(broadcast_id)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception('Broadcast %s failed, it will be resumed at next start', broadcast_id)
+        finally:
+            self.__tasks.pop(broadcast_id, None)
+
+    def __start_sending(self, broadcast_id: int):
+        if broadcast_id not in self.__tasks:
+            self.__tasks[broadcast_id] = asyncio.create_task(self.__send_logged(broadcast_id))
+
+    # Every process sends created broadcast, batches are divided between them by claims
+    async def listen(self, notifications: asyncio.Queue):
+        try:
+            while True:
+                self.__start_sending(int(await notifications.get()))
+        finally:
+            await self.__database.unsubscribe(BROADCASTS_CHANNEL, notifications)
+
+    # Subscription goes before loading, so broadcasts created meanwhile aren't lost
+    async def start(self):
+        notifications = await self.__database.subscribe(BROADCASTS_CHANNEL)
+        self.__listener_task = asyncio.create_task(self.listen(notifications))
+        async with self.__database.acquire() as connection:
+            broadcasts = await statements.UNFINISHED_BROADCASTS.fetch(connection)
+        for broadcast in broadcasts:
+            self.__start_sending(broadcast['broadcast_id'])
+
+    async def close(self):
+        tasks = list(self.__tasks.values())
+        if self.__listener_task:
+            tasks.append(self.__listener_task)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+# aiohttp application signals
+
+async def start_broadcasts(app):
+    await app['broadcasts'].start()
+
+
+async def close_broadcasts(app):
+    await app['broadcasts'].close()
@@ -0,0 +1,110 @@
+from customconfigparser import CustomConfigParser
+from collections import OrderedDict
+from user import User
+import statements
+import asyncio
+import time
+
+# NOTIFY channel of users and families tables changes, payload is chat_id of changed user
+USERS_CHANNEL = 'users_changed'
+
+
+# LRU cache of users objects (with relatives) by chat_id, entries expire after ttl seconds.
+# chat_ids of all registered users are kept apart without expiration (admission control under load)
+
+class UserCache:
+    def __init__(self, size: int = None, ttl: float = None, config: CustomConfigParser = None):
+        if not size:
+            self.__size = int(config.get('Cache', 'user_cache_size'))
+        else:
+            self.__size = size
+        if not ttl:
+            self.__ttl = float(config.get('Cache', 'user_cache_ttl'))
+        else:
+            self.__ttl = ttl
+        self.__users = OrderedDict()    # chat_id: (expiration time, user)
+        self.__known = set()    # chat_ids of users table
+        self.__hits = 0
+        self.__misses = 0
+        self.__database = None
+        self.__listener_task = None
+
+    @property
+    def size(self) -> int:
+        return self.__size
+
+    @property
+    def ttl(self) -> float:
+        return self.__ttl
+
+    @property
+    def hits(self) -> int:
+        return self.__hits
+
+    @property
+    def misses(self) -> int:
+        return self.__misses
+
+    def __len__(self) -> int:
+        return len(self.__users)
+
+    def known(self, chat_id: int) -> bool:  # user is registered, doesn't depend on ttl and size of cache
+        return chat_id in self.__known
+
+    def get(self, chat_id: int) -> User:
+        entry = self.__users.get(chat_id)
+        if entry is None or entry[0] < time.monotonic():
+            self.__misses += 1
+            return None
+        self.__users.move_to_end(chat_id)
+        self.__hits += 1
+        return entry[1]
+
+    def put(self, user: User):
+        self.__known.add(user.chat_id)
+        self.__users[user.chat_id] = (time.monotonic() + self.ttl, user)
+        self.__users.move_to_end(user.chat_id)
+        while len(self.__users) > self.size:
+            self.__users.popitem(last=False)
+
+    # Must be called after registration, role or family changes of users
+    def invalidate(self, *chat_ids: int):
+        for chat_id in chat_ids:
+            self.__users.pop(chat_id, None)
+
+    def clear(self):
+        self.__users.clear()
+
+    # Invalidation by notifications from users and families tables triggers (changes from other processes),
+    # users registered by other processes become known
+    async def listen(self, notifications: asyncio.Queue):
+        try:
+            while True:
+                chat_id = int(await notifications.get())
+                self.invalidate(chat_id)
+                self.__known.add(chat_id)
+        finally:
+            await self.__database.unsubscribe(USERS_CHANNEL, notifications)
+
+    # Subscription goes before loading of known users, so registrations made meanwhile aren't lost
+    async def start(self, database: object):
+        self.__database = database
+        notifications = await database.subscribe(USERS_CHANNEL)
+        self.__listener_task = asyncio.create_task(self.listen(notifications))
+        async with database.acquire() as connection:
+            self.__known.update(record['chat_id'] for record in await statements.KNOWN_CHAT_IDS.fetch(connection))
+
+    async def close(self):
+        if self.__listener_task:
+            self.__listener_task.cancel()
+            await asyncio.gather(self.__listener_task, return_exceptions=True)
+
+
+# aiohttp application signals
+
+async def start_user_cache(app):
+    await app['user_cache'].start(app['database'])
+
+
+async def close_user_cache(app):
+    await app['user_cache'].close()
@@ -1,67 +1,103 @@
 import asyncio
 import asyncpg
-from data import Message, CallbackQuery, Update, Other
+from data import Update, Media, parse_update
 from view import SendMessage, Text, Photo, InlineKeyboardButton, InlineKeyboardMarkup, SendPhoto
 from aiohttp import web
-from user import User, Tutor, Parent, Student
+from admission import DEGRADED, OVERLOADED
+import metrics
+import statements
+import logging
 
+logger = logging.getLogger(__name__)
 
-class Controller:
-    handler_factories = {}
 
+class Controller:
     # Acceptation and saving update data
     @staticmethod
+    @metrics.WEBHOOK_ACK.timed
     async def save_update(request: object):
-        json_update = await request.json()
-        update_type = list(json_update)[1]  # message or callback_query
-        if update_type == 'callback_query':
-            update = CallbackQuery(json_update=json_update)
-        elif update_type == 'message':
-            update = Message(json_update=json_update)
-        else:
-            update = Other(json_update=json_update)
+        if not request.app['accepting_updates']:    # shutting down, Telegram will repeat update later
+            return web.json_response(status=503)
+        admission = request.app['admission']
+        load_level = admission.level()
+        if load_level == OVERLOADED:    # refused before parsing, Telegram will repeat update later
+            admission.refuse('overloaded')
+            return web.json_response(status=503)
+        update = parse_update(await request.json())
+        statements.QUERIES.set([0])     # queries of this update, handle_update task continues counting
         if update.data:     # if data not None (i.e. this update type is supported)
-            await request.app['database'].create_pool_if_not_exist()
-            async with request.app['database'].pool.acquire() as connection:
-                if not await update.exist(connection):    # repeating update check
-                    async with connection.transaction():
-                        await update.find_user(json_update, connection)
-                        if not update.user.is_bot:
-                            await update.data.save(connection, update.user.user_id, update.update_id)
-                            task = asyncio.create_task(Controller.handle_update(request, update))
-                            request.app['background_tasks'].add(task)
-                            task.add_done_callback(request.app['background_tasks'].discard)
+            if load_level == DEGRADED and not request.app['user_cache'].known(update.chat_id):
+                admission.refuse('unknown_user')    # registration of new users waits for lower load
+                return web.json_response(status=503)
+            admission.accept()
+            async with request.app['database'].acquire() as connection:
+                # False for repeating update
+                if await update.ingest(connection, request.app['user_cache'], request.app['media']):
+                    if isinstance(update.data, Media):
+                        request.app['media'].put(update.data)
+                    if not update.user.is_bot:
+                        request.app['sequencer'].register(update.user.chat_id, update.update_id)
+                        task = asyncio.create_task(Controller.handle_update(request, update))
+                        request.app['background_tasks'].add(task)
+                        task.add_done_callback(request.app['background_tasks'].discard)
         return web.json_response()  # 200 (OK) response
 
     """
     Fixing updates order
     Handling saved information from update
-    Creation factory object for generation commands handlers
+    Choosing handler by command and user role
     Responding to user
     """
     @staticmethod
     async def handle_update(request: object, update: Update):
-        async with request.app['database'].pool.acquire() as connection:
-            try:  # fixing updates order
-                await asyncio.wait_for(
-                    update.fix_order(connection, int(request.app['config'].get('Bot', 'response_delay'))),
-                    timeout=int(request.app['config'].get('Bot', 'timeout')))
-            except asyncio.TimeoutError:
-                pass
-            finally:
-                await update.set_updates_responded(connection)  # setting updates responded that wasn't processed
-                await update.set_responded(connection)  # set current update responded
-                last_command = await update.user.last_command(connection)
-                handler_factory = request.app['controller'].handler_factories.get(
-                    last_command,
-                    request.app['controller'].handler_factories.get('/help'))()
-                if handler_factory:
-                    if isinstance(update.user, Tutor) and update.user.current_client:
-                        handler = handler_factory.create_tutor_handler()
-                    elif isinstance(update.user, Student) and update.user.current_client:
-                        handler = handler_factory.create_student_handler()
-                    elif isinstance(update.user, Parent) and update.user.current_client:
-                        handler = handler_factory.create_parent_handler()
+        handler = None
+        try:
+            with metrics.ORDERING_WAIT.time():
+                try:  # fixing updates order (without database connection and handler slot held)
+                    if request.app['config'].get('Bot', 'coordination') == 'database':   # several processes
+                        ordering = update.fix_order(request.app['database'],
+                                                    request.app['sequencer'].reorder_window,
+                                                    float(request.app['config'].get('Bot', 'order_poll_interval')))
                     else:
-                        handler = handler_factory.create_user_handler()
-                    await handler.respond(request, update, connection)
+                        ordering = request.app['sequencer'].wait(update.user.chat_id, update.update_id)
+                    await asyncio.wait_for(ordering, timeout=int(request.app['config'].get('Bot', 'timeout')))
+                except asyncio.TimeoutError:
+                    pass
+                except asyncio.CancelledError:
+                    raise
+                except Exception:   # update is still handled and responded, only its order isn't guaranteed
+                    logger.exception('Can\'t fix order of update %s', update.update_id)
+            async with request.app['limiter']:
+                async with request.app['database'].acquire() as connection:
+                    try:
+                        # replies are written to outbox in this transaction, update is responded only with them
+                        async with connection.transaction():
+                            # setting updates responded that wasn't processed
+                            await update.set_updates_responded(connection)
+                            await update.set_responded(connection)  # set current update responded
+                            update.state = await request.app['states'].advance(connection, update)
+                            handler = request.app['handlers'].resolve(update)
+                            with metrics.HANDLER_RESPOND.time():
+                                await handler.respond(request, update, connection)
+                    except Exception:
+                        request.app['states'].forget(update.user.user_id)
+                        raise
+        finally:
+            request.app['sequencer'].done(update.user.chat_id, update.update_id)  # next update of chat can go
+            queries = statements.QUERIES.get()[0]
+            metrics.QUERIES_PER_UPDATE.observe(queries)
+            if queries > int(request.app['config'].get('Database', 'max_update_queries')):  # N+1 in handler
+                logger.warning('Update %s made %s queries, handler %s', update.update_id, queries,
+                               handler.__class__.__name__ if handler else None)
+
+
+# aiohttp application signals
+
+async def drain_updates(app):
+    app['accepting_updates'] = False
+    timeout = float(app['config'].get('Bot', 'drain_timeout'))
+    started = asyncio.get_event_loop().time()
+    if app['background_tasks']:
+        await asyncio.wait(set(app['background_tasks']), timeout=timeout)
+    await app['outbox'].drain(max(timeout - (asyncio.get_event_loop().time() - started), 0))
+    await app['dispatcher'].drain(max(timeout - (asyncio.get_event_loop().time() - started), 0))
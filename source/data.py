@@ -1,16 +1,25 @@
 from abc import ABC, abstractmethod
 from customconfigparser import CustomConfigParser
-from user import User, Parent, Tutor, Student
+from user import User, Parent, Tutor, Student, user_class
 import asyncpg
 import re
 import asyncio
 import aiohttp
+import logging
 import uuid
+import statements
+
+logger = logging.getLogger(__name__)
+
+# Errors of listener connection, ordering falls back to polling on them
+LISTENER_ERRORS = (OSError, asyncio.TimeoutError, asyncpg.PostgresError, asyncpg.InterfaceError)
 
 
 # Interface for data types classes
 
 class Data(ABC):
+    __slots__ = ('__value', '__value_id')
+
     def __init__(self, value: str, value_id: int):
         self.__value = value
         self.__value_id = value_id
@@ -27,227 +36,239 @@ class Data(ABC):
     def value_id(self, value_id):
         self.__value_id = value_id
 
-    @abstractmethod
-    async def save(self, connection: asyncpg.connection.Connection, user_id: uuid.UUID, update_id: int):
-        pass
+    # value_id stays None for repeating update, media_id of known file saves media write
+    async def save(self,
+                   connection: asyncpg.connection.Connection,
+                   user_id: uuid.UUID,
+                   update_id: int,
+                   media_id: int = None):
+        self.value_id = await statements.SAVE_UPDATE.fetchval(connection,
+                                                              update_id,
+                                                              user_id,
+                                                              str.lower(self.__class__.__name__),
+                                                              self.value,
+                                                              getattr(self, 'caption', None),
+                                                              getattr(self, 'file_unique_id', None),
+                                                              getattr(self, 'file_size', None),
+                                                              getattr(self, 'mime_type', None),
+                                                              media_id)
 
 
 # Types of data that income and parse via Updates from Telegram
 
 class Command(Data):
+    __slots__ = ()
+
     def __init__(self, command: str, value_id: int = None):
         super().__init__(command, value_id)
 
-    async def save(self, connection: asyncpg.connection.Connection, user_id: uuid.UUID, update_id: int):
-        self.value_id = await connection.fetchval('INSERT INTO commands (value) VALUES ($1) RETURNING command_id;',
-                                                  self.value)
-        await connection.execute('INSERT INTO updates (type, user_id, update_id, value_id) VALUES ($1, $2, $3, $4);',
-                                 'command', user_id, update_id, self.value_id)
-
     def __repr__(self):
         return f'Command({self.value})'
 
 
 class Text(Data):
+    __slots__ = ()
+
     def __init__(self, text: str, value_id: int = None):
         super().__init__(text, value_id)
 
-    async def save(self, connection: asyncpg.connection.Connection, user_id: uuid.UUID, update_id: int):
-        self.value_id = await connection.fetchval('INSERT INTO texts (value) VALUES ($1) RETURNING text_id;',
-                                                  self.value)
-        await connection.execute('INSERT INTO updates (type, user_id, update_id, value_id) VALUES ($1, $2, $3, $4);',
-                                 'text', user_id, update_id, self.value_id)
-
     def __repr__(self):
         return f'Text({self.value})'
 
 
-class Audio(Data):
-    def __init__(self, audio_id: str, caption: str = None, value_id: int = None):
-        super().__init__(audio_id, value_id)
+# Files (photo, video...) saved once per file_unique_id in media table, updates refer to it
+
+class Media(Data):
+    __slots__ = ('__caption', '__file_unique_id', '__file_size', '__mime_type')
+
+    def __init__(self,
+                 file_id: str,
+                 caption: str = None,
+                 file_unique_id: str = None,
+                 file_size: int = None,
+                 mime_type: str = None,
+                 value_id: int = None):
+        super().__init__(file_id, value_id)
         self.__caption = caption
+        self.__file_unique_id = file_unique_id
+        self.__file_size = file_size
+        self.__mime_type = mime_type
 
     @property
     def caption(self) -> str:
         return self.__caption
 
-    async def save(self, connection: asyncpg.connection.Connection, user_id: uuid.UUID, update_id: int):
-        self.value_id = await connection.fetchval('INSERT INTO audios (value, caption) '
-                                                  'VALUES ($1, $2) RETURNING audio_id;',
-                                                  self.value, self.caption)
-        await connection.execute('INSERT INTO updates (type, user_id, update_id, value_id) VALUES ($1, $2, $3, $4);',
-                                 'audio', user_id, update_id, self.value_id)
+    @property
+    def file_unique_id(self) -> str:    # the same for all file_id of the file, can't be used for sending
+        return self.__file_unique_id
+
+    @property
+    def file_size(self) -> int:
+        return self.__file_size
+
+    @property
+    def mime_type(self) -> str:
+        return self.__mime_type
 
     def __repr__(self):
-        return f'Audio({self.value}, {self.caption})'
+        return f'{self.__class__.__name__}({self.value}, {self.caption})'
 
 
-class Video(Data):
-    def __init__(self, video_id: str, caption: str = None, value_id: int = None):
-        super().__init__(video_id, value_id)
-        self.__caption = caption
+class Audio(Media):
+    __slots__ = ()
 
-    @property
-    def caption(self) -> str:
-        return self.__caption
 
-    async def save(self, connection: asyncpg.connection.Connection, user_id: uuid.UUID, update_id: int):
-        self.value_id = await connection.fetchval('INSERT INTO videos (value, caption) '
-                                                  'VALUES ($1, $2) RETURNING video_id;',
-                                                  self.value, self.caption)
-        await connection.execute('INSERT INTO updates (type, user_id, update_id, value_id) VALUES ($1, $2, $3, $4);',
-                                 'video', user_id, update_id, self.value_id)
+class Video(Media):
+    __slots__ = ()
 
-    def __repr__(self):
-        return f'Video({self.value}, {self.caption},)'
 
+class Document(Media):
+    __slots__ = ()
 
-class Document(Data):
-    def __init__(self, document_id: str, caption: str = None, value_id: int = None):
-        super().__init__(document_id, value_id)
-        self.__caption = caption
 
-    @property
-    def caption(self) -> str:
-        return self.__caption
+class Photo(Media):
+    __slots__ = ()
 
-    async def save(self, connection: asyncpg.connection.Connection, user_id: uuid.UUID, update_id: int):
-        self.value_id = await connection.fetchval('INSERT INTO documents (value, caption) '
-                                                  'VALUES ($1, $2) RETURNING document_id;',
-                                                  self.value, self.caption)
-        await connection.execute('INSERT INTO updates (type, user_id, update_id, value_id) VALUES ($1, $2, $3, $4);',
-                                 'document', user_id, update_id, self.value_id)
 
-    def __repr__(self):
-        return f'Document({self.value}, {self.caption})'
+COMMAND = re.compile('/[a-z]+')
 
 
-class Photo(Data):
-    def __init__(self, photo_id: str, caption: str = None, value_id: int = None):
-        super().__init__(photo_id, value_id)
-        self.__caption = caption
+# Parsers of message content, the first key found in message defines the type of data
 
-    @property
-    def caption(self) -> str:
-        return self.__caption
+def _parse_text(message: dict) -> Data:
+    command = COMMAND.search(message['text'])
+    if command:
+        return Command(command=command.group())
+    return Text(text=message['text'])
 
-    async def save(self, connection: asyncpg.connection.Connection, user_id: uuid.UUID, update_id: int):
-        self.value_id = await connection.fetchval('INSERT INTO photos (value, caption) '
-                                                  'VALUES ($1, $2) RETURNING photo_id;',
-                                                  self.value, self.caption)
-        await connection.execute('INSERT INTO updates (type, user_id, update_id, value_id) VALUES ($1, $2, $3, $4);',
-                                 'photo', user_id, update_id, self.value_id)
 
-    def __repr__(self):
-        return f'Photo({self.value}, {self.caption})'
+def _media_parser(media_class: type, key: str):
+    def parse(message: dict) -> Data:
+        file = message[key]
+        if key == 'photo':
+            file = file[-1]     # the largest size
+        return media_class(file_id=file['file_id'],
+                           caption=message.get('caption'),
+                           file_unique_id=file.get('file_unique_id'),
+                           file_size=file.get('file_size'),
+                           mime_type=file.get('mime_type'))
+    return parse
+
+
+MESSAGE_PARSERS = (('text', _parse_text),
+                   ('photo', _media_parser(Photo, 'photo')),
+                   ('document', _media_parser(Document, 'document')),
+                   ('audio', _media_parser(Audio, 'audio')),
+                   ('video', _media_parser(Video, 'video')))
 
 
 # Update class (interface) that comes from Telegram
 
 class Update(ABC):
+    __slots__ = ('__update_id', '__chat_id', '__is_bot', 'data', 'user', 'state')
+    key = None  # key of update object in json update (message, callback_query...)
+
     def __init__(self, json_update: dict):
         self.__update_id = json_update['update_id']
-        self.data = self._get_data(json_update)
+        update_object = json_update.get(self.key, {})
+        sender = update_object.get('from', {})
+        self.__chat_id = sender.get('id')
+        self.__is_bot = sender.get('is_bot')
+        self.data = self._get_data(update_object)
         self.user = None
+        self.state = None   # conversation state after this update
 
     @property
     def update_id(self) -> int:
         return self.__update_id
 
-    async def exist(self, connection: asyncpg.connection.Connection) -> int:
-        return await connection.fetchval('SELECT COUNT(*) FROM updates WHERE update_id = $1;', self.update_id)
+    @property
+    def chat_id(self) -> int:   # of sender
+        return self.__chat_id
+
+    @property
+    def is_bot(self) -> bool:
+        return self.__is_bot
 
     async def count_updates_no_resp(self, connection: asyncpg.connection.Connection) -> int:
-        return await connection.fetchval('SELECT COUNT(*) FROM updates '
-                                         'WHERE responded = $1 AND update_id < $2 AND user_id = $3;',
-                                         False, self.update_id, self.user.user_id)
+        return await statements.COUNT_UPDATES_NO_RESP.fetchval(connection, self.update_id, self.user.user_id)
 
     async def set_updates_responded(self, connection: asyncpg.connection.Connection):
-        await connection.execute('UPDATE updates SET responded = $1 '
-                                 'WHERE responded = $2 AND update_id < $3 AND user_id = $4;',
-                                 True, False, self.update_id, self.user.user_id)
+        await statements.SET_UPDATES_RESPONDED.execute(connection, self.update_id, self.user.user_id)
 
-    async def set_responded(self, connection: asyncpg.connection.Connection):
-        await connection.execute('UPDATE updates SET responded = $1 WHERE update_id = $2;', True, self.update_id)
-
-    async def fix_order(self, connection: asyncpg.connection.Connection, response_delay: int):
-        await asyncio.sleep(response_delay)    # waiting for next updates
-        updates_count = await self.count_updates_no_resp(connection)     # how many updates came in wrong order
-        while updates_count:
-            await asyncio.sleep(response_delay)    # waiting for processing previous updates
-            updates_count = await self.count_updates_no_resp(connection)  # how many updates left in wrong order
-
-    async def find_user(self, json_update: dict, connection: asyncpg.connection.Connection):
-        chat_id = json_update[list(json_update)[1]]['from']['id']
-        is_bot = json_update[list(json_update)[1]]['from']['is_bot']
-        if await connection.fetchval('SELECT COUNT(*) FROM users WHERE chat_id = $1;', chat_id) == 0:
-            self.user = User(chat_id, is_bot)
-            await self.user.register(connection)
-        else:
-            user_info = dict(await connection.fetchrow('SELECT phone, name, surname, role, current_client, user_id '
-                                                       'FROM users '
-                                                       'WHERE chat_id = $1;',
-                                                       chat_id))
-            if user_info['role'] == 'parent':
-                self.user = Parent(chat_id,
-                                   is_bot,
-                                   user_info['phone'],
-                                   user_info['name'],
-                                   user_info['surname'],
-                                   user_info['current_client'],
-                                   user_info['user_id'])
-                await self.user.find_relatives(connection)
-            elif user_info['role'] == 'tutor':
-                self.user = Tutor(chat_id,
-                                  is_bot,
-                                  user_info['phone'],
-                                  user_info['name'],
-                                  user_info['surname'],
-                                  user_info['current_client'],
-                                  user_info['user_id'])
-            elif user_info['role'] == 'student':
-                self.user = Student(chat_id,
-                                    is_bot,
-                                    user_info['phone'],
-                                    user_info['name'],
-                                    user_info['surname'],
-                                    user_info['current_client'],
-                                    user_info['user_id'])
-            else:
-                self.user = User(chat_id,
-                                 is_bot,
-                                 user_info['phone'],
-                                 user_info['name'],
-                                 user_info['surname'],
-                                 user_info['current_client'],
-                                 user_info['user_id'])
-        await self.user.find_relatives(connection)
+    @property
+    def channel(self) -> str:   # NOTIFY channel of updates responded for the user
+        return f'responded_{self.user.user_id.hex}'
 
-    @staticmethod
-    def _get_data(json_update: dict) -> Data:
-        message_type = list(json_update['message'])[4]  # photo, document, text and so on
-        if message_type == 'text':
-            command = re.findall('/[a-z]+', json_update['message']['text'])
-            if len(command) == 0:
-                return Text(text=json_update['message']['text'])
-            else:
-                return Command(command=command[0])
-        if message_type == 'document':
-            return Document(document_id=json_update['message']['document']['file_id'],
-                            caption=json_update['message'].get('caption'))
-        elif message_type == 'audio':
-            return Audio(audio_id=json_update['message']['audio']['file_id'],
-                         caption=json_update['message'].get('caption'))
-        elif message_type == 'video':
-            return Video(video_id=json_update['message']['video']['file_id'],
-                         caption=json_update['message'].get('caption'))
-        elif message_type == 'photo':
-            return Photo(photo_id=json_update['message']['photo'][-1]['file_id'],
-                         caption=json_update['message'].get('caption'))
+    async def set_responded(self, connection: asyncpg.connection.Connection):
+        await statements.SET_RESPONDED.execute(connection, self.update_id, self.channel)
+
+    # Ordering between several processes: waiting until previous updates of the user are responded
+    # Connection is taken from pool only for counting, not while waiting.
+    # Updates are counted again every poll_interval, so missed notifications (listener is lost) only slow it down
+    async def fix_order(self, database: object, reorder_window: float, poll_interval: float):
+        await asyncio.sleep(reorder_window)    # waiting for next updates
+        try:
+            notifications = await database.subscribe(self.channel)
+        except LISTENER_ERRORS:
+            logger.warning('Can\'t listen %s, order of update %s is checked by polling', self.channel, self.update_id)
+            notifications = None
+        try:
+            while True:
+                async with database.acquire() as connection:
+                    updates_count = await self.count_updates_no_resp(connection)  # updates came in wrong order
+                if not updates_count:
+                    break
+                if notifications is None:
+                    await asyncio.sleep(poll_interval)
+                    continue
+                try:
+                    await asyncio.wait_for(notifications.get(), timeout=poll_interval)  # processing of previous
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            if notifications is not None:
+                try:
+                    await database.unsubscribe(self.channel, notifications)
+                except LISTENER_ERRORS:
+                    logger.warning('Can\'t unlisten %s', self.channel)
+
+    # Deduplication, user search (registration) and data saving in one round trip
+    async def ingest(self, connection: asyncpg.connection.Connection, user_cache: object, media: object) -> bool:
+        media_id = media.known_id(self.data) if isinstance(self.data, Media) else None
+        self.user = user_cache.get(self.chat_id)
+        if self.user:   # known user, only data is saved
+            await self.data.save(connection, self.user.user_id, self.update_id, media_id)
+            return self.data.value_id is not None   # None for repeating update
+        user_info = await statements.INGEST_UPDATE.fetchrow(connection,
+                                                            self.update_id,
+                                                            self.chat_id,
+                                                            self.is_bot,
+                                                            str.lower(self.data.__class__.__name__),
+                                                            self.data.value,
+                                                            getattr(self.data, 'caption', None),
+                                                            getattr(self.data, 'file_unique_id', None),
+                                                            getattr(self.data, 'file_size', None),
+                                                            getattr(self.data, 'mime_type', None),
+                                                            media_id)
+        if not user_info:   # repeating update
+            return False
+        self.user = user_class(user_info['role'])(self.chat_id,
+                                                  self.is_bot,
+                                                  user_info['phone'],
+                                                  user_info['name'],
+                                                  user_info['surname'],
+                                                  user_info['current_client'],
+                                                  user_info['user_id'])
+        self.user.set_relatives(user_info['relatives'])
+        if not self.is_bot:
+            user_cache.put(self.user)
+        self.data.value_id = user_info['value_id']
+        return True
 
     @staticmethod
     @abstractmethod
-    def _get_data(json_update: dict) -> Data:
+    def _get_data(update_object: dict) -> Data:
         pass
 
     def __repr__(self):
@@ -255,38 +276,39 @@ class Update(ABC):
 
 
 class CallbackQuery(Update):
+    __slots__ = ()
+    key = 'callback_query'
+
     @staticmethod
-    def _get_data(json_update: dict) -> Data:
-        message_type = list(json_update['callback_query'])[4]
-        if message_type == 'data':
-            return Command(json_update['callback_query']['data'])
+    def _get_data(callback_query: dict) -> Data:
+        if 'data' in callback_query:
+            return Command(callback_query['data'])
 
 
 class Message(Update):
+    __slots__ = ()
+    key = 'message'
+
     @staticmethod
-    def _get_data(json_update: dict) -> Data:
-        message_type = list(json_update['message'])[4]  # photo, document, text and so on
-        if message_type == 'text':
-            command = re.findall('/[a-z]+', json_update['message']['text'])
-            if len(command) == 0:
-                return Text(text=json_update['message']['text'])
-            else:
-                return Command(command=command[0])
-        if message_type == 'document':
-            return Document(document_id=json_update['message']['document']['file_id'],
-                            caption=json_update['message'].get('caption'))
-        elif message_type == 'audio':
-            return Audio(audio_id=json_update['message']['audio']['file_id'],
-                         caption=json_update['message'].get('caption'))
-        elif message_type == 'video':
-            return Video(video_id=json_update['message']['video']['file_id'],
-                         caption=json_update['message'].get('caption'))
-        elif message_type == 'photo':
-            return Photo(photo_id=json_update['message']['photo'][-1]['file_id'],
-                         caption=json_update['message'].get('caption'))
+    def _get_data(message: dict) -> Data:
+        for key, parse in MESSAGE_PARSERS:
+            if key in message:
+                return parse(message)
 
 
 class Other(Update):
+    __slots__ = ()
+
     @staticmethod
-    def _get_data(json_update: dict) -> Data:
+    def _get_data(update_object: dict) -> Data:
         pass
+
+
+UPDATE_CLASSES = (Message, CallbackQuery)
+
+
+def parse_update(json_update: dict) -> Update:
+    for update_class in UPDATE_CLASSES:
+        if update_class.key in json_update:
+            return update_class(json_update)
+    return Other(json_update)
@@ -1,5 +1,21 @@
 import asyncpg
+import asyncio
+import contextlib
+import logging
+import time
 from customconfigparser import CustomConfigParser
+from statements import Statement
+import schema
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Pool connection with statements of catalog prepared on connection init
+
+class Connection(asyncpg.Connection):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = {}  # statement name: asyncpg PreparedStatement
 
 
 class Database:
@@ -10,6 +26,12 @@ class Database:
                  password: str = None,
                  database: str = None,
                  pool: asyncpg.Pool = None,
+                 statement_cache_size: int = None,
+                 min_size: int = None,
+                 max_size: int = None,
+                 max_inactive_connection_lifetime: float = None,
+                 command_timeout: float = None,
+                 slow_query_threshold: float = None,
                  config: CustomConfigParser = None):
 
         if not host:
@@ -32,7 +54,38 @@ class Database:
             self.__database = config.get('Database', 'database')
         else:
             self.__database = database
+        if statement_cache_size is None:
+            self.__statement_cache_size = int(config.get('Database', 'statement_cache_size'))
+        else:
+            self.__statement_cache_size = statement_cache_size
+        if not min_size:
+            self.__min_size = int(config.get('Database', 'min_size'))
+        else:
+            self.__min_size = min_size
+        if not max_size:
+            self.__max_size = int(config.get('Database', 'max_size'))
+        else:
+            self.__max_size = max_size
+        if not max_inactive_connection_lifetime:
+            self.__max_inactive_connection_lifetime = float(config.get('Database',
+                                                                       'max_inactive_connection_lifetime'))
+        else:
+            self.__max_inactive_connection_lifetime = max_inactive_connection_lifetime
+        if not command_timeout:
+            self.__command_timeout = float(config.get('Database', 'command_timeout'))
+        else:
+            self.__command_timeout = command_timeout
+        if not slow_query_threshold:
+            self.__slow_query_threshold = float(config.get('Database', 'slow_query_threshold'))
+        else:
+            self.__slow_query_threshold = slow_query_threshold
         self.__pool = pool
+        self.__pool_wait = 0    # smoothed waiting time for pool connection, seconds
+        self.__listener = None  # dedicated connection for LISTEN/NOTIFY
+        self.__listener_lock = None     # created in loop of application at first use
+        self.__subscribers = {}     # channel: set of queues receiving notifications payloads
+        self.__reconnecting = None  # task restoring lost listener connection
+        self.__closing = False
 
     @property
     def host(self) -> str:
@@ -54,18 +107,199 @@ class Database:
     def database(self) -> str:
         return self.__database
 
+    @property
+    def statement_cache_size(self) -> int:
+        return self.__statement_cache_size
+
+    @property
+    def min_size(self) -> int:
+        return self.__min_size
+
+    @property
+    def max_size(self) -> int:
+        return self.__max_size
+
+    @property
+    def max_inactive_connection_lifetime(self) -> float:
+        return self.__max_inactive_connection_lifetime
+
+    @property
+    def command_timeout(self) -> float:
+        return self.__command_timeout
+
+    @property
+    def slow_query_threshold(self) -> float:
+        return self.__slow_query_threshold
+
     @property
     def pool(self) -> asyncpg.Pool:
         return self.__pool
 
+    @property
+    def pool_wait(self) -> float:
+        return self.__pool_wait
+
+    @property
+    def listener(self) -> asyncpg.Connection:
+        return self.__listener
+
     async def create_pool_if_not_exist(self):
         try:
             if not self.pool:
+                Statement.slow_query_threshold = self.slow_query_threshold
+                await self.migrate()    # before statements are prepared by pool connections
                 self.__pool = await asyncpg.create_pool(host=self.host,
                                                         port=self.port,
                                                         user=self.user,
                                                         password=self.password,
-                                                        database=self.database
+                                                        database=self.database,
+                                                        min_size=self.min_size,
+                                                        max_size=self.max_size,
+                                                        max_inactive_connection_lifetime=(
+                                                            self.max_inactive_connection_lifetime),
+                                                        command_timeout=self.command_timeout,
+                                                        statement_cache_size=self.statement_cache_size,
+                                                        connection_class=Connection,
+                                                        init=self.prepare_statements
                                                         )
-        except ConnectionError:
-            print('Can\'t create connection\'s pool for database')
+        except (OSError, asyncio.TimeoutError, asyncpg.PostgresError):
+            logger.exception('Can\'t create connection\'s pool for database')
+            raise
+
+    # Pool connection with waiting time measured (moving average is used by admission control)
+    @contextlib.asynccontextmanager
+    async def acquire(self) -> Connection:
+        started = time.monotonic()
+        async with self.pool.acquire() as connection:
+            wait = time.monotonic() - started
+            metrics.POOL_WAIT.observe(wait)
+            self.__pool_wait = 0.8 * self.__pool_wait + 0.2 * wait
+            yield connection
+
+    # Checking min_size connections of pool before the first update comes
+    async def warm_up(self):
+        async def check():
+            async with self.pool.acquire() as connection:
+                await connection.fetchval('SELECT 1;')
+        await asyncio.gather(*(check() for _ in range(self.min_size)))
+
+    async def close(self, timeout: float):
+        self.__closing = True
+        if self.__reconnecting:
+            self.__reconnecting.cancel()
+            await asyncio.gather(self.__reconnecting, return_exceptions=True)
+        if self.listener and not self.listener.is_closed():
+            await self.listener.close()
+        if self.pool:
+            try:
+                await asyncio.wait_for(self.pool.close(), timeout=timeout)
+            except asyncio.TimeoutError:
+                logger.warning('Connections weren\'t released in %s seconds, pool is terminated', timeout)
+                self.pool.terminate()
+
+    async def connect(self) -> asyncpg.Connection:
+        return await asyncpg.connect(host=self.host,
+                                     port=self.port,
+                                     user=self.user,
+                                     password=self.password,
+                                     database=self.database
+                                     )
+
+    @staticmethod
+    async def prepare_statements(connection: Connection):
+        for statement in Statement.catalog.values():
+            connection.prepared[statement.name] = await connection.prepare(statement.sql)
+
+    # Applying migrations from schema module that weren't applied yet
+    async def migrate(self):
+        connection = await self.connect()
+        try:
+            async with connection.transaction():
+                await connection.execute('SELECT pg_advisory_xact_lock($1);', schema.LOCK_ID)
+                await connection.execute('CREATE TABLE IF NOT EXISTS schema_migrations ('
+                                         'version integer PRIMARY KEY, '
+                                         'description text, '
+                                         'applied_at timestamptz NOT NULL DEFAULT now());')
+                applied = {record['version'] for record in await connection.fetch('SELECT version '
+                                                                                  'FROM schema_migrations;')}
+                for version, description, statements in schema.MIGRATIONS:
+                    if version not in applied:
+                        for statement in statements:
+                            await connection.execute(statement)
+                        await connection.execute('INSERT INTO schema_migrations (version, description) '
+                                                 'VALUES ($1, $2);',
+                                                 version, description)
+        finally:
+            await connection.close()
+
+    # run_app starts new loop after create_app, lock made in __init__ would be bound to other loop (Python < 3.10)
+    def __get_listener_lock(self) -> asyncio.Lock:
+        if self.__listener_lock is None:
+            self.__listener_lock = asyncio.Lock()
+        return self.__listener_lock
+
+    # Channels of existing subscribers are listened again on new connection
+    async def create_listener_if_not_exist(self):
+        if not self.listener or self.listener.is_closed():
+            self.__listener = await self.connect()
+            self.__listener.add_termination_listener(self.__listener_terminated)
+            for channel in self.__subscribers:
+                await self.__listener.add_listener(channel, self.__notify)
+
+    def __listener_terminated(self, connection: asyncpg.Connection):
+        if connection is self.listener and not self.__closing and not self.__reconnecting:
+            logger.warning('Listener connection is lost, notifications of %s are missed until reconnection',
+                           ', '.join(self.__subscribers) or 'no channels')
+            self.__reconnecting = asyncio.get_event_loop().create_task(self.__reconnect())
+
+    async def __reconnect(self):
+        delay = 1
+        try:
+            while True:
+                try:
+                    async with self.__get_listener_lock():
+                        await self.create_listener_if_not_exist()
+                    logger.warning('Listener connection is restored')
+                    return
+                except (OSError, asyncio.TimeoutError, asyncpg.PostgresError, asyncpg.InterfaceError):
+                    logger.warning('Can\'t restore listener connection, next attempt in %s seconds', delay)
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 30)
+        finally:
+            self.__reconnecting = None
+
+    # LISTEN is issued only for the first subscriber of channel, UNLISTEN after the last one
+    async def subscribe(self, channel: str) -> asyncio.Queue:
+        queue = asyncio.Queue()
+        async with self.__get_listener_lock():  # listener connection can't run queries concurrently
+            await self.create_listener_if_not_exist()
+            if channel not in self.__subscribers:
+                await self.listener.add_listener(channel, self.__notify)
+                self.__subscribers[channel] = set()
+            self.__subscribers[channel].add(queue)
+        return queue
+
+    async def unsubscribe(self, channel: str, queue: asyncio.Queue):
+        async with self.__get_listener_lock():
+            subscribers = self.__subscribers.get(channel)
+            if subscribers is not None:
+                subscribers.discard(queue)
+                if not subscribers:
+                    del self.__subscribers[channel]
+                    if self.listener and not self.listener.is_closed():     # else not listened after reconnection
+                        await self.listener.remove_listener(channel, self.__notify)
+
+    def __notify(self, connection: asyncpg.Connection, pid: int, channel: str, payload: str):
+        for queue in self.__subscribers.get(channel, ()):
+            queue.put_nowait(payload)
+
+
+# aiohttp application signals
+
+async def start_database(app):
+    await app['database'].create_pool_if_not_exist()
+    await app['database'].warm_up()
+
+
+async def close_database(app):
+    await app['database'].close(float(app['config'].get('Bot', 'drain_timeout')))
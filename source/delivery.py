@@ -0,0 +1,125 @@
+from customconfigparser import CustomConfigParser
+import logging
+import asyncio
+import random
+import time
+
+logger = logging.getLogger(__name__)
+
+"""
+Delivery policy of Bot API requests
+429 is retried after retry_after of answer, 5xx, timeouts and connection errors are retried
+with exponential backoff and full jitter, other errors (400 bad request, 403 bot blocked by user) aren't retried.
+Circuit breaker pauses all sends of process while Bot API is degraded (flood control, series of server errors),
+pause opened by process is shared with other processes through its listeners
+"""
+
+# Outcomes of delivery
+SENT = 'sent'
+REJECTED = 'rejected'   # request can't succeed, not retried
+FAILED = 'failed'   # attempts are over
+
+
+class DeliveryResult:
+    __slots__ = ('__outcome', '__attempts', '__status', '__error_code', '__description', '__result')
+
+    def __init__(self, outcome: str, attempts: int, status: int = None, error_code: int = None,
+                 description: str = None, result: dict = None):
+        self.__outcome = outcome
+        self.__attempts = attempts
+        self.__status = status  # HTTP status of the last attempt, None for timeout or connection error
+        self.__error_code = error_code
+        self.__description = description
+        self.__result = result  # sent message of Bot API answer
+
+    @property
+    def outcome(self) -> str:
+        return self.__outcome
+
+    @property
+    def ok(self) -> bool:
+        return self.__outcome == SENT
+
+    @property
+    def attempts(self) -> int:
+        return self.__attempts
+
+    @property
+    def status(self) -> int:
+        return self.__status
+
+    @property
+    def error_code(self) -> int:
+        return self.__error_code
+
+    @property
+    def description(self) -> str:
+        return self.__description
+
+    @property
+    def result(self) -> dict:
+        return self.__result
+
+    def __repr__(self):
+        return f'DeliveryResult({self.outcome}, attempts={self.attempts}, error_code={self.error_code})'
+
+
+# Delay before retry number attempt + 1: random in [0, min(backoff_max, backoff_base * 2 ** attempt)]
+
+def backoff(attempt: int, backoff_base: float, backoff_max: float) -> float:
+    return random.uniform(0, min(backoff_max, backoff_base * 2 ** attempt))
+
+
+class CircuitBreaker:
+    def __init__(self, threshold: int = None, pause_time: float = None, config: CustomConfigParser = None):
+        if not threshold:
+            self.__threshold = int(config.get('Dispatcher', 'breaker_threshold'))
+        else:
+            self.__threshold = threshold
+        if not pause_time:
+            self.__pause_time = float(config.get('Dispatcher', 'breaker_pause'))
+        else:
+            self.__pause_time = pause_time
+        self.__failures = 0     # consecutive server errors
+        self.__open_until = 0   # monotonic time
+        self.__listeners = []   # callbacks(seconds) of opening by this process
+
+    @property
+    def threshold(self) -> int:
+        return self.__threshold
+
+    @property
+    def pause_time(self) -> float:
+        return self.__pause_time
+
+    @property
+    def open(self) -> bool:
+        return time.monotonic() < self.__open_until
+
+    def succeed(self):
+        self.__failures = 0
+
+    # After pause the first failure opens circuit again (half-open state)
+    def fail(self):
+        self.__failures += 1
+        if self.__failures >= self.threshold:
+            self.pause(self.pause_time)
+            self.__failures = self.threshold - 1
+
+    # shared is False for pause opened by other process
+    def pause(self, seconds: float, shared: bool = True):
+        if not self.open:
+            logger.warning('Bot API is degraded, sending is paused for %s seconds', seconds)
+            if shared:
+                for listener in self.__listeners:
+                    listener(seconds)
+        self.__open_until = max(self.__open_until, time.monotonic() + seconds)
+
+    def add_listener(self, callback):
+        self.__listeners.append(callback)
+
+    async def wait(self):
+        delay = self.__open_until - time.monotonic()
+        while delay > 0:
+            await asyncio.sleep(delay)
+            delay = self.__open_until - time.monotonic()
@@ -0,0 +1,263 @@
+from customconfigparser import CustomConfigParser
+from httpclient import HttpClient
+from view import SendData
+from delivery import DeliveryResult, CircuitBreaker, FAILED
+from collections import deque, Counter
+import itertools
+import statements
+import metrics
+import logging
+import asyncio
+import time
+
+logger = logging.getLogger(__name__)
+
+# NOTIFY channel of Bot API pauses, payload is wall clock time of pause end (flood control is per bot)
+PAUSES_CHANNEL = 'bot_api_paused'
+
+# Priorities of outbound messages (lower is sent first)
+INTERACTIVE = 0
+BULK = 1
+
+
+# Token bucket: rate tokens per second, up to capacity tokens stored
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.__rate = rate
+        self.__capacity = capacity
+        self.__tokens = capacity
+        self.__updated = time.monotonic()
+
+    @property
+    def rate(self) -> float:
+        return self.__rate
+
+    @property
+    def capacity(self) -> float:
+        return self.__capacity
+
+    def _refill(self):
+        now = time.monotonic()
+        self.__tokens = min(self.capacity, self.__tokens + (now - self.__updated) * self.rate)
+        self.__updated = now
+
+    def full(self) -> bool:
+        self._refill()
+        return self.__tokens >= self.capacity
+
+    def delay(self) -> float:  # seconds until one token is available
+        self._refill()
+        if self.__tokens >= 1:
+            return 0
+        return (1 - self.__tokens) / self.rate
+
+    def consume(self):
+        self.__tokens -= 1
+
+    async def acquire(self):
+        delay = self.delay()
+        while delay:
+            await asyncio.sleep(delay)
+            delay = self.delay()
+        self.consume()
+
+
+"""
+Central outbound dispatcher
+Messages are kept in FIFO queue per chat, chats wait in priority queue for a free sender,
+so messages of one chat are sent in order and never faster than chat_rate
+"""
+
+
+class Dispatcher:
+    max_idle_buckets = 10000    # idle per-chat buckets kept before pruning
+
+    def __init__(self,
+                 http_client: HttpClient,
+                 senders: int = None,
+                 global_rate: float = None,
+                 global_burst: float = None,
+                 chat_rate: float = None,
+                 chat_burst: float = None,
+                 breaker: CircuitBreaker = None,
+                 config: CustomConfigParser = None):
+
+        self.__http_client = http_client
+        if not senders:
+            self.__senders = int(config.get('Dispatcher', 'senders'))
+        else:
+            self.__senders = senders
+        if not global_rate:
+            global_rate = float(config.get('Dispatcher', 'global_rate'))
+        if not global_burst:
+            global_burst = float(config.get('Dispatcher', 'global_burst'))
+        if not chat_rate:
+            self.__chat_rate = float(config.get('Dispatcher', 'chat_rate'))
+        else:
+            self.__chat_rate = chat_rate
+        if not chat_burst:
+            self.__chat_burst = float(config.get('Dispatcher', 'chat_burst'))
+        else:
+            self.__chat_burst = chat_burst
+        if not breaker:
+            self.__breaker = CircuitBreaker(config=config)
+        else:
+            self.__breaker = breaker
+        self.__global_bucket = TokenBucket(global_rate, global_burst)
+        self.__chat_buckets = {}    # chat_id: TokenBucket
+        self.__pending = {}     # chat_id: deque of (priority, send_data, future)
+        self.__sequence = itertools.count()     # keeps FIFO order between chats with equal priority
+        self.__sending = 0
+        self.__outcomes = Counter()     # outcome: deliveries
+        self.__queue = None
+        self.__workers = []
+        self.__database = None  # for sharing pauses of breaker with other processes
+        self.__tasks = set()
+
+    @property
+    def senders(self) -> int:
+        return self.__senders
+
+    @property
+    def chat_rate(self) -> float:
+        return self.__chat_rate
+
+    @property
+    def chat_burst(self) -> float:
+        return self.__chat_burst
+
+    @property
+    def breaker(self) -> CircuitBreaker:
+        return self.__breaker
+
+    @property
+    def outcomes(self) -> Counter:
+        return self.__outcomes
+
+    @property
+    def queue_size(self) -> int:
+        return sum(len(pending) for pending in self.__pending.values())
+
+    @property
+    def sending(self) -> int:
+        return self.__sending
+
+    def put(self, send_data: SendData, priority: int = INTERACTIVE) -> asyncio.Future:
+        future = asyncio.get_event_loop().create_future()  # resolves to DeliveryResult
+        pending = self.__pending.get(send_data.chat_id)
+        if pending is None:
+            self.__pending[send_data.chat_id] = deque([(priority, send_data, future)])
+            self.__schedule(send_data.chat_id, priority)
+        else:
+            pending.append((priority, send_data, future))
+        return future
+
+    def __schedule(self, chat_id: int, priority: int):
+        self.__queue.put_nowait((priority, next(self.__sequence), chat_id))
+
+    def __chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self.__chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self.__chat_buckets) >= self.max_idle_buckets:
+                self.__prune_buckets()
+            bucket = self.__chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    def __prune_buckets(self):
+        for chat_id in [chat_id for chat_id, bucket in self.__chat_buckets.items()
+                        if chat_id not in self.__pending and bucket.full()]:
+            del self.__chat_buckets[chat_id]
+
+    async def __work(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            priority, sequence, chat_id = await self.__queue.get()
+            bucket = self.__chat_bucket(chat_id)
+            delay = bucket.delay()
+            if delay:   # chat limit reached, other chats are served meanwhile
+                loop.call_later(delay, self.__queue.put_nowait, (priority, sequence, chat_id))
+                continue
+            bucket.consume()
+            await self.__global_bucket.acquire()
+            pending = self.__pending[chat_id]
+            priority, send_data, future = pending.popleft()
+            self.__sending += 1
+            started = time.monotonic()
+            try:
+                result = await send_data.send(self.__http_client.session, self.breaker)
+            except asyncio.CancelledError:
+                pending.appendleft((priority, send_data, future))
+                raise
+            except Exception:
+                logger.exception('Can\'t send %s to chat %s', send_data.__class__.__name__, chat_id)
+                result = DeliveryResult(FAILED, 1, description='exception in send()')
+            finally:
+                self.__sending -= 1
+            metrics.SEND_LATENCY.observe(time.monotonic() - started)
+            metrics.SEND_ATTEMPTS.observe(result.attempts)
+            self.__outcomes[result.outcome] += 1
+            if not future.done():
+                future.set_result(result)
+            if pending:
+                self.__schedule(chat_id, pending[0][0])
+            else:
+                del self.__pending[chat_id]
+
+    # Waiting until queued messages are sent, but not longer than timeout
+    async def drain(self, timeout: float):
+        deadline = time.monotonic() + timeout
+        while (self.queue_size or self.sending) and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        if self.queue_size:
+            logger.warning('%s messages weren\'t sent before shutdown', self.queue_size)
+
+    def __share_pause(self, seconds: float):
+        task = asyncio.create_task(self.__notify_pause(time.time() + seconds))
+        self.__tasks.add(task)
+        task.add_done_callback(self.__tasks.discard)
+
+    async def __notify_pause(self, until: float):
+        try:
+            async with self.__database.acquire() as connection:
+                await statements.NOTIFY.execute(connection, PAUSES_CHANNEL, str(until))
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception('Can\'t share pause of Bot API with other processes')
+
+    async def listen_pauses(self, notifications: asyncio.Queue):
+        try:
+            while True:
+                seconds = float(await notifications.get()) - time.time()
+                if seconds > 0:
+                    self.breaker.pause(seconds, shared=False)
+        finally:
+            await self.__database.unsubscribe(PAUSES_CHANNEL, notifications)
+
+    # With database pauses of breaker are shared by all processes of bot
+    async def start(self, database: object = None):
+        self.__queue = asyncio.PriorityQueue()
+        self.__workers = [asyncio.create_task(self.__work()) for _ in range(self.senders)]
+        if database:
+            self.__database = database
+            notifications = await database.subscribe(PAUSES_CHANNEL)
+            self.__workers.append(asyncio.create_task(self.listen_pauses(notifications)))
+            self.breaker.add_listener(self.__share_pause)
+
+    async def close(self):
+        tasks = self.__workers + list(self.__tasks)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self.__workers = []
+
+
+# aiohttp application signals
+
+async def start_dispatcher(app):
+    await app['dispatcher'].start(app['database'])
+
+
+async def close_dispatcher(app):
+    await app['dispatcher'].close()
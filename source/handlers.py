@@ -1,7 +1,14 @@
 from abc import ABC, abstractmethod
+from registry import HandlerRegistry
+from state import FORMS
 import view
 import data
 import asyncpg
+import re
+
+registry = HandlerRegistry(default='/help')
+
+PHONE = re.compile(r'\+7\d{10}')   # registration answer: +79219876543
 
 
 class UserHandler(ABC):
@@ -28,24 +35,7 @@ class StudentHandler(ABC):
         pass
 
 
-class HandlerFactory(ABC):
-    @abstractmethod
-    def create_tutor_handler(self) -> TutorHandler:
-        pass
-
-    @abstractmethod
-    def create_student_handler(self) -> StudentHandler:
-        pass
-
-    @abstractmethod
-    def create_parent_handler(self) -> ParentHandler:
-        pass
-
-    @abstractmethod
-    def create_user_handler(self) -> UserHandler:
-        pass
-
-
+@registry.route('/help', roles=('user',))
 class UserHelp(UserHandler):
     async def respond(self, request: object, update: data.Update, connection: asyncpg.connection.Connection):
         text = 'Выберите действие:'
@@ -53,9 +43,10 @@ class UserHelp(UserHandler):
         keyboard.add_button(view.InlineKeyboardButton('Начать регистрацию', '/register'))
         data_to_send = data.Text(text)
         response = view.SendMessage(request.app['config'], update.user.chat_id, data_to_send, keyboard)
-        await response.send()
+        await request.app['outbox'].put(connection, response, update.update_id)
 
 
+@registry.route('/help', '/start', roles=('student',))
 class StudentHelp(StudentHandler):
     async def respond(self, request: object, update: data.Update, connection: asyncpg.connection.Connection):
         text = f'{update.user.name}, выберите необходимое действие:'
@@ -75,9 +66,10 @@ class StudentHelp(StudentHandler):
         keyboard.add_button(view.InlineKeyboardButton('Редактировать профиль', '/alter_profile'))
         data_to_send = data.Text(text)
         response = view.SendMessage(request.app['config'], update.user.chat_id, data_to_send, keyboard)
-        await response.send()
+        await request.app['outbox'].put(connection, response, update.update_id)
 
 
+@registry.route('/help', '/start', roles=('parent',))
 class ParentHelp(ParentHandler):
     async def respond(self, request: object, update: data.Update, connection: asyncpg.connection.Connection):
         text = f'{update.user.name}, выберите необходимое действие:'
@@ -94,9 +86,10 @@ class ParentHelp(ParentHandler):
         keyboard.add_button(view.InlineKeyboardButton('Редактировать профиль', '/alter_profile'))
         data_to_send = data.Text(text)
         response = view.SendMessage(request.app['config'], update.user.chat_id, data_to_send, keyboard)
-        await response.send()
+        await request.app['outbox'].put(connection, response, update.update_id)
 
 
+@registry.route('/help', '/start', roles=('tutor',))
 class TutorHelp(TutorHandler):
     async def respond(self, request: object, update: data.Update, connection: asyncpg.connection.Connection):
         text = f'{update.user.name}, choose an action:'
@@ -115,25 +108,14 @@ class TutorHelp(TutorHandler):
         keyboard.add_line()
         keyboard.add_button(view.InlineKeyboardButton('Confirm new user', '/confirm_user'))
         keyboard.add_button(view.InlineKeyboardButton('Edit profile', '/alter_profile'))
+        keyboard.add_line()
+        keyboard.add_button(view.InlineKeyboardButton('Message to all students', '/broadcast'))
         data_to_send = data.Text(text)
         response = view.SendMessage(request.app['config'], update.user.chat_id, data_to_send, keyboard)
-        await response.send()
-
-
-class HelpFactory(HandlerFactory):
-    def create_tutor_handler(self) -> TutorHelp:
-        return TutorHelp()
-
-    def create_student_handler(self) -> StudentHelp:
-        return StudentHelp()
-
-    def create_parent_handler(self) -> ParentHelp:
-        return ParentHelp()
-
-    def create_user_handler(self) -> UserHelp:
-        return UserHelp()
+        await request.app['outbox'].put(connection, response, update.update_id)
 
 
+@registry.route('/start', roles=('user',))
 class UserStart(UserHandler):
     async def respond(self, request: object, update: data.Update, connection: asyncpg.connection.Connection):
         text = 'Добро пожаловать! :) С помощью бота ученики всегда будут в курсе расписания, смогут отправлять и ' \
@@ -144,34 +126,20 @@ class UserStart(UserHandler):
         keyboard.add_button(view.InlineKeyboardButton('Начать регистрацию', '/register'))
         data_to_send = data.Text(text)
         response = view.SendMessage(request.app['config'], update.user.chat_id, data_to_send, keyboard)
-        await response.send()
-
-
-class StartFactory(HandlerFactory):
-    def create_tutor_handler(self) -> TutorHelp:
-        return TutorHelp()
-
-    def create_student_handler(self) -> StudentHelp:
-        return StudentHelp()
-
-    def create_parent_handler(self) -> ParentHelp:
-        return ParentHelp()
-
-    def create_user_handler(self) -> UserStart:
-        return UserStart()
+        await request.app['outbox'].put(connection, response, update.update_id)
 
 
+@registry.route('/register', roles=('user',))
 class UserRegister(UserHandler):
+    @staticmethod
+    def valid(answers: tuple) -> bool:
+        return (len(answers) == FORMS['/register'] and answers[0] in ('parent', 'student')
+                and PHONE.fullmatch(answers[3] or '') is not None)
+
     async def respond(self, request: object, update: data.Update, connection: asyncpg.connection.Connection):
-        result = await connection.fetch('SELECT value FROM texts JOIN updates ON texts.text_id = updates.value_id '
-                                        'WHERE update_id > (SELECT MAX(update_id) FROM updates '
-                                        'WHERE type = $1 AND user_id = $2 AND responded = $3) '
-                                        'AND type = $4 AND user_id = $5 AND responded = $6 ORDER BY update_id;',
-                                        'command', update.user.user_id, True, 'text', update.user.user_id, True)
-        data_for_profile = [record['value'] for record in result]
-        steps = len(data_for_profile)
+        steps = update.state.step
         keyboard = view.InlineKeyboardMarkup()
-        if not data_for_profile:
+        if not steps:
             text = 'Регистрация. Шаг 1 из 4. ' \
                    'Выберите из предложенных вариантов, кем Вы являетесь:'
             keyboard.add_button(view.InlineKeyboardButton('Родитель', 'parent'))
@@ -186,7 +154,10 @@ class UserRegister(UserHandler):
         elif steps == 3:
             text = 'Регистрация. Шаг 4 из 4. ' \
                    'Введите Ваш номер телефона без пробелов и тире, начиная с +7 (например, +79219876543):'
-        elif steps == 4:
+        elif steps == FORMS['/register'] and self.valid(update.state.answers):
+            # role, name, surname and phone, user is confirmed by tutor later (current_client)
+            await update.user.save_profile(connection, *update.state.answers)
+            request.app['user_cache'].invalidate(update.user.chat_id)
             text = 'Регистрация прошла успешно. Дождитесь подтверждения Вашей учетной записи – Вы получите ' \
                    'уведомление об этом.'
         else:
@@ -196,9 +167,10 @@ class UserRegister(UserHandler):
         keyboard.add_button(view.InlineKeyboardButton('Прервать регистрацию', '/help'))
         data_to_send = data.Text(text)
         response = view.SendMessage(request.app['config'], update.user.chat_id, data_to_send, keyboard)
-        await response.send()
+        await request.app['outbox'].put(connection, response, update.update_id)
 
 
+@registry.route('/register', roles=('student', 'parent', 'tutor'))
 class StudentRegister(UserHandler):
     async def respond(self, request: object, update: data.Update, connection: asyncpg.connection.Connection):
         text = 'Вы уже прошли ранее регистрацию. Подсказать, какой функционал Вам доступен?'
@@ -206,18 +178,32 @@ class StudentRegister(UserHandler):
         keyboard.add_button(view.InlineKeyboardButton('Показать доступные действия', '/help'))
         data_to_send = data.Text(text)
         response = view.SendMessage(request.app['config'], update.user.chat_id, data_to_send, keyboard)
-        await response.send()
+        await request.app['outbox'].put(connection, response, update.update_id)
 
 
-class RegisterFactory(HandlerFactory):
-    def create_tutor_handler(self) -> StudentRegister:
-        return StudentRegister()
-
-    def create_student_handler(self) -> StudentRegister:
-        return StudentRegister()
-
-    def create_parent_handler(self) -> StudentRegister:
-        return StudentRegister()
-
-    def create_user_handler(self) -> UserRegister:
-        return UserRegister()
+@registry.route('/broadcast', roles=('tutor',))
+class TutorBroadcast(TutorHandler):
+    async def respond(self, request: object, update: data.Update, connection: asyncpg.connection.Connection):
+        steps = update.state.step
+        keyboard = view.InlineKeyboardMarkup()
+        if not steps:
+            text = 'Send the message for all students (text, photo or document with caption):'
+        elif steps == 1 and isinstance(update.data, (data.Text, data.Photo, data.Document)):
+            if isinstance(update.data, data.Text):
+                file_type, file_id, message_text = None, None, update.data.value
+            else:
+                file_type, file_id, message_text = (update.data.__class__.__name__.lower(),
+                                                    update.data.value,
+                                                    update.data.caption)
+            # sent by outbox after this transaction is committed
+            await request.app['broadcasts'].broadcast(connection, update.user.user_id, message_text, 'students',
+                                                      file_type=file_type, file_id=file_id)
+            text = 'The message is being sent to all students.'
+        elif steps == 1:
+            text = 'Only text, photo or document can be sent. Choose the action again.'
+        else:
+            text = 'The message was already sent. Choose the action again to send one more.'
+        keyboard.add_button(view.InlineKeyboardButton('Show available actions', '/help'))
+        data_to_send = data.Text(text)
+        response = view.SendMessage(request.app['config'], update.user.chat_id, data_to_send, keyboard)
+        await request.app['outbox'].put(connection, response, update.update_id)
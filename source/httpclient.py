@@ -0,0 +1,64 @@
+import aiohttp
+from customconfigparser import CustomConfigParser
+
+
+# Long-lived HTTP session for all outbound Bot API calls (one per process)
+
+class HttpClient:
+    def __init__(self,
+                 connections_limit: int = None,
+                 connections_limit_per_host: int = None,
+                 keepalive_timeout: float = None,
+                 config: CustomConfigParser = None):
+
+        if not connections_limit:
+            self.__connections_limit = int(config.get('Bot', 'connections_limit'))
+        else:
+            self.__connections_limit = connections_limit
+        if not connections_limit_per_host:
+            self.__connections_limit_per_host = int(config.get('Bot', 'connections_limit_per_host'))
+        else:
+            self.__connections_limit_per_host = connections_limit_per_host
+        if not keepalive_timeout:
+            self.__keepalive_timeout = float(config.get('Bot', 'keepalive_timeout'))
+        else:
+            self.__keepalive_timeout = keepalive_timeout
+        self.__session = None
+
+    @property
+    def connections_limit(self) -> int:
+        return self.__connections_limit
+
+    @property
+    def connections_limit_per_host(self) -> int:
+        return self.__connections_limit_per_host
+
+    @property
+    def keepalive_timeout(self) -> float:
+        return self.__keepalive_timeout
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        return self.__session
+
+    async def create_session_if_not_exist(self):
+        if not self.session or self.session.closed:
+            connector = aiohttp.TCPConnector(limit=self.connections_limit,
+                                             limit_per_host=self.connections_limit_per_host,
+                                             keepalive_timeout=self.keepalive_timeout,
+                                             ttl_dns_cache=300)
+            self.__session = aiohttp.ClientSession(connector=connector)
+
+    async def close(self):
+        if self.session and not self.session.closed:
+            await self.session.close()
+
+
+# aiohttp application signals
+
+async def start_http_client(app):
+    await app['http_client'].create_session_if_not_exist()
+
+
+async def close_http_client(app):
+    await app['http_client'].close()
@@ -0,0 +1,42 @@
+from customconfigparser import CustomConfigParser
+import asyncio
+
+
+# Limit of updates handled concurrently, used as async context manager
+
+class Limiter:
+    def __init__(self, limit: int = None, config: CustomConfigParser = None):
+        if not limit:
+            self.__limit = int(config.get('Bot', 'max_handlers'))
+        else:
+            self.__limit = limit
+        self.__semaphore = None     # created in loop of application at first use
+        self.__waiting = 0
+        self.__active = 0
+
+    @property
+    def limit(self) -> int:
+        return self.__limit
+
+    @property
+    def waiting(self) -> int:  # queue depth
+        return self.__waiting
+
+    @property
+    def active(self) -> int:
+        return self.__active
+
+    async def __aenter__(self):
+        if self.__semaphore is None:
+            self.__semaphore = asyncio.Semaphore(self.limit)
+        self.__waiting += 1
+        try:
+            await self.__semaphore.acquire()
+        finally:
+            self.__waiting -= 1
+        self.__active += 1
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        self.__active -= 1
+        self.__semaphore.release()
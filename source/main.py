@@ -1,20 +1,107 @@
 from customconfigparser import CustomConfigParser
 from pathlib import Path
-from database import Database
-from controller import Controller
+from database import Database, start_database, close_database
+from httpclient import HttpClient, start_http_client, close_http_client
+from dispatcher import Dispatcher, start_dispatcher, close_dispatcher
+from sequencer import Sequencer
+from limiter import Limiter
+from admission import AdmissionControl, start_admission, close_admission
+from cache import UserCache, start_user_cache, close_user_cache
+from state import StateStore
+from media import MediaRegistry
+from reminders import ReminderScheduler, start_reminders, close_reminders
+from broadcasts import Broadcaster, start_broadcasts, close_broadcasts
+from outbox import Outbox, start_outbox, close_outbox
+from retention import RetentionWorker, start_retention, close_retention
+from controller import Controller, drain_updates
+from metrics import handle_metrics, start_metrics
+from workers import Supervisor, pool_sizes, global_rates, start_supervisor, close_supervisor
 from aiohttp import web
+import argparse
 import handlers
 
-if __name__ == '__main__':
+
+def read_config() -> CustomConfigParser:
+    config = CustomConfigParser()
+    config.read(Path.cwd() / 'config.ini')  # path_to_config_file / config_name
+    return config
+
+
+def create_app(config: CustomConfigParser, workers: int = 1, worker: int = 0) -> web.Application:
     app = web.Application()
-    app['config'] = CustomConfigParser()
-    app['config'].read(Path.cwd() / 'config.ini')  # path_to_config_file / config_name
-    app['database'] = Database(config=app['config'])
+    app['config'] = config
+    min_size, max_size = pool_sizes(app['config'], workers)
+    app['database'] = Database(min_size=min_size, max_size=max_size, config=app['config'])
+    app['http_client'] = HttpClient(config=app['config'])
+    global_rate, global_burst = global_rates(app['config'], workers)
+    app['dispatcher'] = Dispatcher(app['http_client'], global_rate=global_rate, global_burst=global_burst,
+                                   config=app['config'])
+    app['sequencer'] = Sequencer(config=app['config'])
+    app['limiter'] = Limiter(config=app['config'])
+    app['user_cache'] = UserCache(config=app['config'])
+    app['states'] = StateStore(config=app['config'])
+    app['media'] = MediaRegistry(config=app['config'])
+    app['retention'] = RetentionWorker(app['database'], config=app['config'])
+    app['outbox'] = Outbox(app['database'], app['dispatcher'], shard=worker, shards=workers, config=app['config'])
+    app['reminders'] = ReminderScheduler(app['database'], app['outbox'], config=app['config'])
+    app['broadcasts'] = Broadcaster(app['database'], app['outbox'], app['media'], config=app['config'])
     app['background_tasks'] = set()
+    app['accepting_updates'] = True
+    app['admission'] = AdmissionControl(app['database'], app['background_tasks'], app['limiter'],
+                                        config=app['config'])
     app['controller'] = Controller()
-    app['controller'].handler_factories = {'/start': handlers.StartFactory,
-                                           '/help': handlers.HelpFactory,
-                                           '/register': handlers.RegisterFactory
-                                           }
-    app.add_routes([web.post(f'/', app['controller'].save_update)])
-    web.run_app(app)
+    app['handlers'] = handlers.registry.build()
+    app.add_routes([web.post(f'/', app['controller'].save_update),
+                    web.get('/metrics', handle_metrics)])
+    app.on_startup.append(start_database)
+    app.on_startup.append(start_http_client)
+    app.on_startup.append(start_dispatcher)
+    app.on_startup.append(start_user_cache)
+    app.on_startup.append(start_retention)
+    app.on_startup.append(start_reminders)
+    app.on_startup.append(start_broadcasts)
+    app.on_startup.append(start_outbox)
+    app.on_startup.append(start_admission)
+    app.on_startup.append(start_metrics)
+    app.on_shutdown.append(drain_updates)
+    app.on_cleanup.append(close_admission)
+    app.on_cleanup.append(close_dispatcher)     # nothing is sent after claimed rows of outbox are stored or released
+    app.on_cleanup.append(close_outbox)
+    app.on_cleanup.append(close_broadcasts)
+    app.on_cleanup.append(close_reminders)
+    app.on_cleanup.append(close_retention)
+    app.on_cleanup.append(close_user_cache)
+    app.on_cleanup.append(close_http_client)
+    app.on_cleanup.append(close_database)
+    return app
+
+
+# Worker process of multi-process mode, runs in spawned interpreter
+def run_worker(worker: int, workers: int, path: str):
+    web.run_app(create_app(read_config(), workers, worker), path=path, print=None)
+
+
+# Front process of multi-process mode, forwards updates to workers by chat_id
+def create_front_app(config: CustomConfigParser, workers: int) -> web.Application:
+    app = web.Application()
+    app['config'] = config
+    app['supervisor'] = Supervisor(run_worker, workers=workers, config=app['config'])
+    app.add_routes([web.post(f'/', app['supervisor'].forward),
+                    web.get('/metrics/{worker}', app['supervisor'].forward_metrics)])
+    app.on_startup.append(start_supervisor)
+    app.on_cleanup.append(close_supervisor)
+    return app
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--workers', type=int, default=None)  # [Workers] workers by default
+    args = parser.parse_args()
+    config = read_config()
+    workers = args.workers or int(config.get('Workers', 'workers'))
+    if workers > 1:
+        web.run_app(create_front_app(config, workers), host=args.host, port=args.port)
+    else:
+        web.run_app(create_app(config), host=args.host, port=args.port)
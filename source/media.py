@@ -0,0 +1,63 @@
+from customconfigparser import CustomConfigParser
+from collections import OrderedDict
+from data import Media
+import asyncpg
+import statements
+
+"""
+Registry of files known to bot by file_unique_id
+file_id of file received once is reused for sending it again (homework worksheets broadcast and so on),
+lookups are served from memory (LRU), database is read only for files not seen by this process.
+Update with file known by the same file_id refers to media row without writing it
+"""
+
+
+class MediaRegistry:
+    def __init__(self, size: int = None, config: CustomConfigParser = None):
+        if not size:
+            self.__size = int(config.get('Cache', 'media_cache_size'))
+        else:
+            self.__size = size
+        self.__files = OrderedDict()    # file_unique_id: (media_id, file_id, type)
+
+    @property
+    def size(self) -> int:
+        return self.__size
+
+    def __len__(self) -> int:
+        return len(self.__files)
+
+    def __remember(self, file_unique_id: str, entry: tuple):
+        self.__files[file_unique_id] = entry
+        self.__files.move_to_end(file_unique_id)
+        while len(self.__files) > self.size:
+            self.__files.popitem(last=False)
+
+    # Called for saved media updates, value_id of saved media is media_id
+    def put(self, media: Media):
+        if media.file_unique_id and media.value_id is not None:
+            self.__remember(media.file_unique_id, (media.value_id, media.value, str.lower(media.__class__.__name__)))
+
+    # media_id of file received before with the same file_id, None if media row must be written
+    def known_id(self, media: Media) -> int:
+        entry = self.get(media.file_unique_id) if media.file_unique_id else None
+        if entry is not None and entry[1] == media.value:
+            return entry[0]
+        return None
+
+    def get(self, file_unique_id: str) -> tuple:
+        entry = self.__files.get(file_unique_id)
+        if entry is not None:
+            self.__files.move_to_end(file_unique_id)
+        return entry
+
+    # file_id for sending, None for unknown file
+    async def file_id(self, connection: asyncpg.connection.Connection, file_unique_id: str) -> str:
+        entry = self.get(file_unique_id)
+        if entry is None:
+            record = await statements.MEDIA.fetchrow(connection, file_unique_id)
+            if not record:
+                return None
+            entry = (record['media_id'], record['file_id'], record['type'])
+            self.__remember(file_unique_id, entry)
+        return entry[1]
@@ -0,0 +1,190 @@
+from aiohttp import web
+import functools
+import bisect
+import time
+import statements
+
+"""
+Metrics of application in Prometheus text format (GET /metrics)
+Histograms are module constants observed at call sites,
+gauges read current values of application objects when metrics are requested
+"""
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+ATTEMPTS_BUCKETS = (1, 2, 3, 4, 5, 10)
+QUERIES_BUCKETS = (1, 2, 3, 5, 8, 13, 20, 50, 100)
+
+
+class Metric:
+    catalog = {}    # name: Metric
+    type = None
+
+    def __init__(self, name: str, description: str):
+        if name in Metric.catalog:
+            raise ValueError(f'Metric {name} is already in catalog')
+        self.__name = name
+        self.__description = description
+        Metric.catalog[name] = self
+
+    @property
+    def name(self) -> str:
+        return self.__name
+
+    @property
+    def description(self) -> str:
+        return self.__description
+
+    def samples(self) -> list:  # (suffix, labels text, value)
+        return []
+
+    def render(self) -> str:
+        lines = [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} {self.type}']
+        lines.extend(f'{self.name}{suffix}{labels} {value}' for suffix, labels, value in self.samples())
+        return '\n'.join(lines)
+
+
+class Timer:
+    def __init__(self, histogram):
+        self.__histogram = histogram
+        self.__started = None
+
+    def __enter__(self):
+        self.__started = time.monotonic()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.__histogram.observe(time.monotonic() - self.__started)
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name: str, description: str, buckets: tuple = LATENCY_BUCKETS):
+        super().__init__(name, description)
+        self.__buckets = tuple(buckets)
+        self.__counts = [0] * (len(self.__buckets) + 1)     # the last one is +Inf
+        self.__sum = 0
+
+    @property
+    def buckets(self) -> tuple:
+        return self.__buckets
+
+    @property
+    def count(self) -> int:
+        return sum(self.__counts)
+
+    @property
+    def sum(self) -> float:
+        return self.__sum
+
+    def observe(self, value: float):
+        self.__counts[bisect.bisect_left(self.__buckets, value)] += 1
+        self.__sum += value
+
+    def time(self) -> Timer:    # with HISTOGRAM.time(): ...
+        return Timer(self)
+
+    def timed(self, coroutine_function):   # decorator of coroutine function
+        @functools.wraps(coroutine_function)
+        async def wrapper(*args, **kwargs):
+            with self.time():
+                return await coroutine_function(*args, **kwargs)
+        return wrapper
+
+    def samples(self) -> list:
+        samples = []
+        cumulative = 0
+        for bound, count in zip(self.__buckets + ('+Inf',), self.__counts):
+            cumulative += count
+            samples.append(('_bucket', f'{{le="{bound}"}}', cumulative))
+        samples.append(('_sum', '', self.__sum))
+        samples.append(('_count', '', cumulative))
+        return samples
+
+
+# Value is read by function when metrics are requested, function returns number or {label value: number}
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def __init__(self, name: str, description: str, label: str = None):
+        super().__init__(name, description)
+        self.__label = label
+        self.__function = None
+
+    def set_function(self, function):
+        self.__function = function
+
+    def samples(self) -> list:
+        if self.__function is None:
+            return []
+        value = self.__function()
+        if isinstance(value, dict):
+            return [('', f'{{{self.__label}="{label}"}}', number) for label, number in value.items()]
+        return [('', '', value)]
+
+
+# Gauge of value that only grows
+
+class Counter(Gauge):
+    type = 'counter'
+
+
+def render() -> str:
+    return '\n'.join(metric.render() for metric in Metric.catalog.values()) + '\n'
+
+
+# Webhook and updates handling
+
+WEBHOOK_ACK = Histogram('webhook_ack_seconds', 'Time of webhook request handling in save_update')
+ORDERING_WAIT = Histogram('ordering_wait_seconds', 'Time of waiting for previous updates of chat')
+HANDLER_RESPOND = Histogram('handler_respond_seconds', 'Time of handler respond()')
+BACKGROUND_TASKS = Gauge('background_tasks', 'Updates being handled in background tasks')
+HANDLERS_WAITING = Gauge('handlers_waiting', 'Updates waiting for handler slot of limiter')
+HANDLERS_ACTIVE = Gauge('handlers_active', 'Updates holding handler slot of limiter')
+UPDATES_ACCEPTED = Counter('updates_accepted_total', 'Updates accepted by admission control')
+UPDATES_SHED = Counter('updates_shed_total', 'Updates refused by admission control', label='reason')
+LOOP_LAG = Histogram('event_loop_lag_seconds', 'Delay of event loop in waking up sleeping task')
+
+# Outbound messages
+
+SEND_LATENCY = Histogram('send_latency_seconds', 'Time of SendData.send() with all attempts')
+SEND_ATTEMPTS = Histogram('send_attempts', 'Bot API requests made by one SendData.send()', ATTEMPTS_BUCKETS)
+OUTBOUND_QUEUE = Gauge('outbound_queue_size', 'Messages waiting in dispatcher')
+DELIVERIES = Counter('deliveries_total', 'Results of SendData.send()', label='outcome')
+CIRCUIT_OPEN = Gauge('bot_api_circuit_open', 'Sending is paused by circuit breaker (1) or not (0)')
+
+# Database and caches
+
+POOL_WAIT = Histogram('pool_acquire_wait_seconds', 'Time of waiting for connection of pool')
+POOL_IN_USE = Gauge('pool_connections_in_use', 'Connections of pool acquired now')
+QUERIES_PER_UPDATE = Histogram('update_queries', 'Statements executed for one update (saving and handling)',
+                               QUERIES_BUCKETS)
+STATEMENT_CALLS = Counter('statement_calls_total', 'Calls of statement', label='statement')
+STATEMENT_TIME = Counter('statement_seconds_total', 'Time of statement calls', label='statement')
+STATEMENT_MAX_TIME = Gauge('statement_max_seconds', 'The slowest call of statement', label='statement')
+STATEMENT_ROWS = Counter('statement_rows_total', 'Rows returned or changed by statement', label='statement')
+USER_CACHE = Counter('user_cache_requests_total', 'Users cache lookups', label='result')
+
+
+async def handle_metrics(request: object):
+    return web.Response(text=render(), content_type='text/plain')
+
+
+# aiohttp application signals
+
+async def start_metrics(app):
+    BACKGROUND_TASKS.set_function(lambda: len(app['background_tasks']))
+    HANDLERS_WAITING.set_function(lambda: app['limiter'].waiting)
+    HANDLERS_ACTIVE.set_function(lambda: app['limiter'].active)
+    UPDATES_ACCEPTED.set_function(lambda: app['admission'].accepted)
+    UPDATES_SHED.set_function(lambda: app['admission'].shed)
+    OUTBOUND_QUEUE.set_function(lambda: app['dispatcher'].queue_size)
+    DELIVERIES.set_function(lambda: dict(app['dispatcher'].outcomes))
+    CIRCUIT_OPEN.set_function(lambda: int(app['dispatcher'].breaker.open))
+    POOL_IN_USE.set_function(lambda: app['database'].pool.get_size() - app['database'].pool.get_idle_size())
+    STATEMENT_CALLS.set_function(lambda: {name: s.calls for name, s in statements.Statement.catalog.items()})
+    STATEMENT_TIME.set_function(lambda: {name: s.total_time for name, s in statements.Statement.catalog.items()})
+    STATEMENT_MAX_TIME.set_function(lambda: {name: s.max_time for name, s in statements.Statement.catalog.items()})
+    STATEMENT_ROWS.set_function(lambda: {name: s.rows for name, s in statements.Statement.catalog.items()})
+    USER_CACHE.set_function(lambda: {'hit': app['user_cache'].hits, 'miss': app['user_cache'].misses})
@@ -0,0 +1,235 @@
+from customconfigparser import CustomConfigParser
+from view import SendData, StoredSendData
+from dispatcher import INTERACTIVE
+import statements
+import logging
+import asyncio
+import json
+
+logger = logging.getLogger(__name__)
+
+# NOTIFY channel of outbox table inserts (sent at commit, once per statement)
+OUTBOX_CHANNEL = 'outbox_added'
+
+"""
+Transactional outbox of replies
+Handlers write replies to outbox table in the transaction that sets update responded,
+so update is never responded without its replies and replies of rolled back update are never sent.
+Delivery workers claim pending rows of chats of this process by batches (the same sharding as updates,
+so order and rate limit of chat stay in one dispatcher), send them through dispatcher and store outcome.
+Claims of one process are serialized, so dispatcher gets messages of chat in outbox order
+(interactive replies are claimed before bulk messages of reminders and broadcasts).
+Rows of process that died while sending are released after stale_timeout and sent again:
+delivery is at-least-once. At shutdown workers deliver the rest of their chats' rows until drain timeout,
+then dispatcher is closed (before outbox), so outcome of rows sent meanwhile is stored and only unsent rows are released
+"""
+
+
+class Outbox:
+    def __init__(self,
+                 database: object,
+                 dispatcher: object,
+                 shard: int = 0,
+                 shards: int = 1,
+                 workers: int = None,
+                 batch_size: int = None,
+                 poll_interval: float = None,
+                 stale_timeout: float = None,
+                 keep_hours: int = None,
+                 config: CustomConfigParser = None):
+
+        self.__database = database
+        self.__dispatcher = dispatcher
+        self.__config = config  # for messages to send
+        self.__shard = shard    # worker process number
+        self.__shards = shards  # worker processes
+        if not workers:
+            self.__workers = int(config.get('Outbox', 'workers'))
+        else:
+            self.__workers = workers
+        if not batch_size:
+            self.__batch_size = int(config.get('Outbox', 'batch_size'))
+        else:
+            self.__batch_size = batch_size
+        if not poll_interval:
+            self.__poll_interval = float(config.get('Outbox', 'poll_interval'))
+        else:
+            self.__poll_interval = poll_interval
+        if not stale_timeout:
+            self.__stale_timeout = float(config.get('Outbox', 'stale_timeout'))
+        else:
+            self.__stale_timeout = stale_timeout
+        if not keep_hours:
+            self.__keep_hours = int(config.get('Outbox', 'keep_hours'))
+        else:
+            self.__keep_hours = keep_hours
+        self.__claiming = None
+        self.__wake = None  # rows were added
+        self.__claimed = {}     # outbox_id: future of dispatcher, claimed by this process and not stored yet
+        self.__closing = False
+        self.__tasks = []
+        self.__delivery_tasks = []
+
+    @property
+    def shard(self) -> int:
+        return self.__shard
+
+    @property
+    def shards(self) -> int:
+        return self.__shards
+
+    @property
+    def workers(self) -> int:
+        return self.__workers
+
+    @property
+    def batch_size(self) -> int:
+        return self.__batch_size
+
+    @property
+    def poll_interval(self) -> float:   # seconds between checks without notifications
+        return self.__poll_interval
+
+    @property
+    def stale_timeout(self) -> float:
+        return self.__stale_timeout
+
+    @property
+    def keep_hours(self) -> int:    # delivered rows are kept for investigation
+        return self.__keep_hours
+
+    # Must be called in transaction of update handling, update_id is None for messages not replying to update
+    async def put(self, connection: object, send_data: SendData, update_id: int = None, priority: int = INTERACTIVE):
+        await statements.INSERT_OUTBOX.execute(connection,
+                                               send_data.chat_id,
+                                               send_data.method,
+                                               json.dumps(send_data.dict()),
+                                               update_id,
+                                               priority)
+
+    # Must be called in transaction that decides sending (claim of broadcast batch...)
+    async def put_many(self, connection: object, sends: list, priority: int = INTERACTIVE):
+        if sends:
+            await statements.INSERT_OUTBOX_MANY.execute(connection,
+                                                        [send_data.chat_id for send_data in sends],
+                                                        [send_data.method for send_data in sends],
+                                                        [json.dumps(send_data.dict()) for send_data in sends],
+                                                        priority)
+
+    # Sends one batch, returns number of claimed rows
+    async def deliver(self) -> int:
+        async with self.__claiming:
+            async with self.__database.acquire() as connection:
+                records = await statements.CLAIM_OUTBOX.fetch(connection, self.batch_size, self.shard, self.shards)
+            records = sorted(records, key=lambda record: record['outbox_id'])
+            futures = [self.__dispatcher.put(StoredSendData(self.__config,
+                                                            record['chat_id'],
+                                                            record['method'],
+                                                            json.loads(record['payload'])),
+                                                record['priority'])
+                       for record in records]
+            self.__claimed.update(zip((record['outbox_id'] for record in records), futures))
+        if not records:
+            return 0
+        results = await asyncio.gather(*futures)
+        delivered = {}  # outcome: outbox ids
+        for record, result in zip(records, results):
+            delivered.setdefault(result.outcome, []).append(record['outbox_id'])
+        async with self.__database.acquire() as connection:
+            async with connection.transaction():
+                for outcome, outbox_ids in delivered.items():
+                    await statements.SET_OUTBOX_STATUS.execute(connection, outbox_ids, outcome)
+        for record in records:
+            self.__claimed.pop(record['outbox_id'], None)
+        return len(records)
+
+    async def work(self):
+        while True:
+            self.__wake.clear()
+            try:
+                if await self.deliver():
+                    continue
+            except asyncio.CancelledError:
+                raise
+            except Exception:   # claimed rows are released after stale_timeout
+                logger.exception('Can\'t deliver outbox batch')
+            if self.__closing:  # nothing left to deliver
+                return
+            try:
+                await asyncio.wait_for(self.__wake.wait(), timeout=self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    async def listen(self, notifications: asyncio.Queue):
+        try:
+            while True:
+                await notifications.get()
+                self.__wake.set()
+        finally:
+            await self.__database.unsubscribe(OUTBOX_CHANNEL, notifications)
+
+    # Releasing rows of dead processes and deleting old delivered rows
+    async def maintain(self):
+        while True:
+            try:
+                async with self.__database.acquire() as connection:
+                    await statements.RELEASE_STALE_OUTBOX.execute(connection, self.stale_timeout)
+                    await statements.DELETE_DELIVERED_OUTBOX.execute(connection, self.keep_hours)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception('Can\'t maintain outbox')
+            await asyncio.sleep(self.stale_timeout)
+
+    # Lock and event are created in loop of application (run_app starts new one)
+    async def start(self):
+        self.__claiming = asyncio.Lock()
+        self.__wake = asyncio.Event()
+        notifications = await self.__database.subscribe(OUTBOX_CHANNEL)
+        self.__tasks.append(asyncio.create_task(self.listen(notifications)))
+        self.__tasks.append(asyncio.create_task(self.maintain()))
+        self.__delivery_tasks = [asyncio.create_task(self.work()) for _ in range(self.workers)]
+
+    # Delivering claimed and pending rows of this process, but not longer than timeout
+    async def drain(self, timeout: float):
+        self.__closing = True
+        if self.__wake:
+            self.__wake.set()
+        if self.__delivery_tasks:
+            await asyncio.wait(self.__delivery_tasks, timeout=timeout)
+        if self.__claimed:
+            logger.warning('%s claimed replies weren\'t delivered before shutdown', len(self.__claimed))
+
+    async def close(self):
+        self.__closing = True
+        tasks = self.__tasks + self.__delivery_tasks
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self.__tasks = []
+        self.__delivery_tasks = []
+        if self.__claimed:  # dispatcher is closed, so futures don't change anymore
+            delivered = {}  # outcome: outbox ids
+            unsent = []     # futures are cancelled with delivery tasks or not resolved
+            for outbox_id, future in self.__claimed.items():
+                if future.done() and not future.cancelled():
+                    delivered.setdefault(future.result().outcome, []).append(outbox_id)
+                else:
+                    unsent.append(outbox_id)
+            async with self.__database.acquire() as connection:
+                async with connection.transaction():
+                    for outcome, outbox_ids in delivered.items():
+                        await statements.SET_OUTBOX_STATUS.execute(connection, outbox_ids, outcome)
+                    # other process (or the next start) sends them
+                    await statements.RELEASE_OUTBOX.execute(connection, unsent)
+            self.__claimed.clear()
+
+
+# aiohttp application signals
+
+async def start_outbox(app):
+    await app['outbox'].start()
+
+
+async def close_outbox(app):
+    await app['outbox'].close()
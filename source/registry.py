@@ -0,0 +1,61 @@
+from data import Update, Command
+from types import MappingProxyType
+
+ROLES = ('user', 'student', 'parent', 'tutor')     # user is not registered or not confirmed yet
+
+"""
+Registry of handlers
+Handler classes are registered by decorator for commands (or callback data) and roles,
+build() creates one instance of every class and immutable (command, role): handler map.
+Callback data 'name:arguments' is routed by its prefix 'name:'
+"""
+
+
+class Router:
+    def __init__(self, routes: dict, default: str):
+        self.__routes = MappingProxyType(routes)
+        self.__default = default
+
+    @property
+    def routes(self) -> MappingProxyType:
+        return self.__routes
+
+    @property
+    def default(self) -> str:   # command for updates without route
+        return self.__default
+
+    @staticmethod
+    def route_key(value: str) -> str:
+        prefix, separator, arguments = value.partition(':')
+        return prefix + separator
+
+    # Callback data has its own route or goes to the current command of conversation (registration answers...)
+    def resolve(self, update: Update) -> object:
+        role = update.user.role if update.user.current_client else 'user'
+        if isinstance(update.data, Command) and not update.data.value.startswith('/'):
+            handler = self.__routes.get((self.route_key(update.data.value), role))
+            if handler:
+                return handler
+        return self.__routes.get((update.state.command, role)) or self.__routes.get((self.default, role))
+
+
+class HandlerRegistry:
+    def __init__(self, default: str = '/help'):
+        self.__default = default
+        self.__routes = {}  # (command, role): handler class
+
+    def route(self, *commands: str, roles: tuple = ROLES):
+        def register(handler_class: type) -> type:
+            for command in commands:
+                for role in roles:
+                    if (command, role) in self.__routes:
+                        raise ValueError(f'Handler for {command} ({role}) is already registered')
+                    self.__routes[(command, role)] = handler_class
+            return handler_class
+        return register
+
+    # Handlers are stateless, so one instance of class serves all updates
+    def build(self) -> Router:
+        instances = {handler_class: handler_class() for handler_class in set(self.__routes.values())}
+        return Router({key: instances[handler_class] for key, handler_class in self.__routes.items()},
+                      self.__default)
@@ -0,0 +1,152 @@
+from customconfigparser import CustomConfigParser
+from data import Text
+from view import SendMessage
+from dispatcher import BULK
+import statements
+import datetime
+import logging
+import asyncio
+import heapq
+
+logger = logging.getLogger(__name__)
+
+# NOTIFY channel of lessons table changes, payload is lesson_id
+LESSONS_CHANNEL = 'lessons_changed'
+
+"""
+Reminders about beginning of lessons
+Upcoming lessons are loaded once at start, then kept up to date by notifications of lessons table trigger.
+Reminders wait in heap of (remind time, lesson_id, starts_at); rescheduled and cancelled lessons
+are deleted lazily: heap entry is skipped if it doesn't match current starts_at of lesson.
+Reminder is claimed in transaction that writes its messages to outbox, so restarts and several processes
+don't send it twice and reminder isn't lost if process dies or sending fails
+"""
+
+
+class ReminderScheduler:
+    def __init__(self,
+                 database: object,
+                 outbox: object,
+                 beginning_of_lesson: int = None,
+                 config: CustomConfigParser = None):
+
+        self.__database = database
+        self.__outbox = outbox
+        self.__config = config  # for messages to send
+        if not beginning_of_lesson:
+            self.__beginning_of_lesson = int(config.get('Notifications', 'beginning_of_lesson'))
+        else:
+            self.__beginning_of_lesson = beginning_of_lesson
+        self.__heap = []
+        self.__lessons = {}     # lesson_id: starts_at of scheduled reminder
+        self.__wake = None  # earlier reminder was scheduled, created in start()
+        self.__tasks = []
+
+    @property
+    def beginning_of_lesson(self) -> int:   # minutes before lesson
+        return self.__beginning_of_lesson
+
+    def __len__(self) -> int:
+        return len(self.__lessons)
+
+    def schedule(self, lesson_id: int, starts_at: datetime.datetime):
+        if self.__lessons.get(lesson_id) == starts_at:
+            return
+        self.__lessons[lesson_id] = starts_at
+        remind_at = starts_at - datetime.timedelta(minutes=self.beginning_of_lesson)
+        if self.__wake and (not self.__heap or remind_at < self.__heap[0][0]):  # run() waits for later or nothing
+            self.__wake.set()
+        heapq.heappush(self.__heap, (remind_at, lesson_id, starts_at))
+        if len(self.__heap) > 2 * len(self.__lessons) + 1000:   # too many deleted entries
+            self.__heap = [entry for entry in self.__heap if self.__lessons.get(entry[1]) == entry[2]]
+            heapq.heapify(self.__heap)
+
+    def unschedule(self, lesson_id: int):
+        self.__lessons.pop(lesson_id, None)
+
+    async def load(self):
+        async with self.__database.acquire() as connection:
+            lessons = await statements.UPCOMING_LESSONS.fetch(connection,
+                                                              datetime.datetime.now(datetime.timezone.utc))
+        for lesson in lessons:
+            self.schedule(lesson['lesson_id'], lesson['starts_at'])
+
+    async def __reload(self, lesson_id: int):
+        async with self.__database.acquire() as connection:
+            lesson = await statements.LESSON.fetchrow(connection, lesson_id)
+        if (not lesson or lesson['cancelled'] or lesson['reminded_for'] == lesson['starts_at'] or
+                lesson['starts_at'] <= datetime.datetime.now(datetime.timezone.utc)):
+            self.unschedule(lesson_id)
+        else:
+            self.schedule(lesson_id, lesson['starts_at'])
+
+    async def listen(self, notifications: asyncio.Queue):
+        try:
+            while True:
+                lesson_id = int(await notifications.get())
+                try:
+                    await self.__reload(lesson_id)
+                except asyncio.CancelledError:
+                    raise
+                except Exception:
+                    logger.exception('Can\'t reload lesson %s', lesson_id)
+        finally:
+            await self.__database.unsubscribe(LESSONS_CHANNEL, notifications)
+
+    async def remind(self, lesson_id: int, starts_at: datetime.datetime):
+        text = Text(f'Напоминание: занятие начнётся в {starts_at.astimezone():%H:%M}')
+        async with self.__database.acquire() as connection:
+            async with connection.transaction():
+                recipients = await statements.CLAIM_REMINDER.fetch(connection, lesson_id, starts_at)
+                for recipient in recipients:
+                    await self.__outbox.put(connection, SendMessage(self.__config, recipient['chat_id'], text),
+                                            priority=BULK)
+
+    async def run(self):
+        while True:
+            self.__wake.clear()
+            if self.__heap:
+                delay = (self.__heap[0][0] - datetime.datetime.now(datetime.timezone.utc)).total_seconds()
+            else:
+                delay = None
+            if delay is None or delay > 0:
+                try:
+                    await asyncio.wait_for(self.__wake.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            remind_at, lesson_id, starts_at = heapq.heappop(self.__heap)
+            if self.__lessons.get(lesson_id) != starts_at:  # rescheduled or cancelled
+                continue
+            del self.__lessons[lesson_id]
+            try:
+                await self.remind(lesson_id, starts_at)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception('Can\'t send reminder of lesson %s', lesson_id)
+
+    # Subscription goes before loading, so changes made meanwhile aren't lost.
+    # Event is created in loop of application (run_app starts new one)
+    async def start(self):
+        self.__wake = asyncio.Event()
+        notifications = await self.__database.subscribe(LESSONS_CHANNEL)
+        self.__tasks.append(asyncio.create_task(self.listen(notifications)))
+        await self.load()
+        self.__tasks.append(asyncio.create_task(self.run()))
+
+    async def close(self):
+        for task in self.__tasks:
+            task.cancel()
+        await asyncio.gather(*self.__tasks, return_exceptions=True)
+        self.__tasks = []
+
+
+# aiohttp application signals
+
+async def start_reminders(app):
+    await app['reminders'].start()
+
+
+async def close_reminders(app):
+    await app['reminders'].close()
@@ -0,0 +1,143 @@
+from customconfigparser import CustomConfigParser
+import statements
+import datetime
+import logging
+import asyncio
+
+logger = logging.getLogger(__name__)
+
+LOCK_ID = 7318002   # advisory lock of retention run, so only one process archives partitions
+
+"""
+Background retention of updates table
+Creates monthly partitions of updates in advance and archives (or drops) partitions
+older than keep_months together with their rows of data tables (texts, commands, photos...),
+deletes processed update ids older than dedup_hours
+"""
+
+
+class RetentionWorker:
+    policies = ('keep', 'archive', 'drop')
+
+    def __init__(self,
+                 database: object,
+                 policy: str = None,
+                 keep_months: int = None,
+                 premake_months: int = None,
+                 interval: float = None,
+                 dedup_hours: int = None,
+                 config: CustomConfigParser = None):
+
+        self.__database = database
+        if not policy:
+            self.__policy = config.get('Retention', 'policy')
+        else:
+            self.__policy = policy
+        if self.__policy not in self.policies:
+            raise ValueError(f'Retention policy should be one of {", ".join(self.policies)}')
+        if not keep_months:
+            self.__keep_months = int(config.get('Retention', 'keep_months'))
+        else:
+            self.__keep_months = keep_months
+        if not premake_months:
+            self.__premake_months = int(config.get('Retention', 'premake_months'))
+        else:
+            self.__premake_months = premake_months
+        if not interval:
+            self.__interval = float(config.get('Retention', 'interval'))
+        else:
+            self.__interval = interval
+        if not dedup_hours:
+            self.__dedup_hours = int(config.get('Retention', 'dedup_hours'))
+        else:
+            self.__dedup_hours = dedup_hours
+        self.__task = None
+
+    @property
+    def policy(self) -> str:
+        return self.__policy
+
+    @property
+    def keep_months(self) -> int:
+        return self.__keep_months
+
+    @property
+    def premake_months(self) -> int:
+        return self.__premake_months
+
+    @property
+    def interval(self) -> float:
+        return self.__interval
+
+    @property
+    def dedup_hours(self) -> int:   # update_id of processed update is kept for finding repeats
+        return self.__dedup_hours
+
+    @staticmethod
+    def _add_months(month: datetime.date, months: int) -> datetime.date:
+        month_index = month.year * 12 + month.month - 1 + months
+        return datetime.date(month_index // 12, month_index % 12 + 1, 1)
+
+    # Returns names of archived (dropped) partitions.
+    # Every step is a transaction of its own, so failed step doesn't roll back others
+    # and updates table is locked only while partition is detached, not while its rows are moved
+    async def run_once(self) -> list:
+        this_month = datetime.date.today().replace(day=1)
+        archived = []
+        async with self.__database.pool.acquire() as connection:
+            if not await statements.TRY_RETENTION_LOCK.fetchval(connection, LOCK_ID):
+                return archived     # other process is running retention
+            try:
+                await statements.DELETE_PROCESSED_UPDATES.execute(connection, self.dedup_hours)
+                for months in range(self.premake_months + 1):
+                    month = self._add_months(this_month, months)
+                    try:
+                        await statements.CREATE_UPDATES_PARTITION.fetchval(connection, month)
+                    except asyncio.CancelledError:
+                        raise
+                    except Exception:
+                        logger.exception('Can\'t create partition of updates for %s', month)
+                if self.policy == 'keep':
+                    return archived
+                cutoff = self._add_months(this_month, -self.keep_months)
+                partitions = await statements.OLD_UPDATES_PARTITIONS.fetch(
+                    connection, datetime.datetime(cutoff.year, cutoff.month, cutoff.day))
+                for partition in partitions:
+                    if partition['attached']:
+                        await statements.DETACH_UPDATES_PARTITION.fetchval(connection, partition['name'])
+                    await statements.ARCHIVE_UPDATES_PARTITION.fetchval(connection,
+                                                                        partition['name'],
+                                                                        self.policy == 'drop')
+                    archived.append(partition['name'])
+            finally:
+                await statements.RETENTION_UNLOCK.fetchval(connection, LOCK_ID)
+        return archived
+
+    async def run(self):
+        while True:
+            try:
+                for partition in await self.run_once():
+                    logger.info('Partition %s: %s', partition, self.policy)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception('Retention of updates failed')
+            await asyncio.sleep(self.interval)
+
+    async def start(self):
+        self.__task = asyncio.create_task(self.run())
+
+    async def close(self):
+        if self.__task:
+            self.__task.cancel()
+            await asyncio.gather(self.__task, return_exceptions=True)
+
+
+# aiohttp application signals
+
+async def start_retention(app):
+    await app['retention'].start()
+
+
+async def close_retention(app):
+    await app['retention'].close()
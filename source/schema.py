@@ -0,0 +1,564 @@
+from statements import Statement
+import json
+
+"""
+Versioned database schema, applied by Database.migrate() when pool is created
+Every migration is (version, description, statements), applied migrations are stored in schema_migrations.
+Statements of early migrations are idempotent, so databases created by hand are adopted as is
+"""
+
+MIGRATIONS = [
+    (1, 'base tables', [
+        'CREATE EXTENSION IF NOT EXISTS pgcrypto;',   # gen_random_uuid() before PostgreSQL 13
+        '''
+        CREATE TABLE IF NOT EXISTS users (
+            user_id uuid PRIMARY KEY DEFAULT gen_random_uuid(),
+            chat_id bigint NOT NULL,
+            phone text,
+            name text,
+            surname text,
+            role text,
+            current_client boolean NOT NULL DEFAULT FALSE
+        );
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS families (
+            parent_id uuid NOT NULL REFERENCES users,
+            child_id uuid NOT NULL REFERENCES users,
+            PRIMARY KEY (parent_id, child_id)
+        );
+        ''',
+        'CREATE TABLE IF NOT EXISTS commands (command_id serial PRIMARY KEY, value text NOT NULL);',
+        'CREATE TABLE IF NOT EXISTS texts (text_id serial PRIMARY KEY, value text NOT NULL);',
+        'CREATE TABLE IF NOT EXISTS audios (audio_id serial PRIMARY KEY, value text NOT NULL, caption text);',
+        'CREATE TABLE IF NOT EXISTS videos (video_id serial PRIMARY KEY, value text NOT NULL, caption text);',
+        'CREATE TABLE IF NOT EXISTS documents (document_id serial PRIMARY KEY, value text NOT NULL, caption text);',
+        'CREATE TABLE IF NOT EXISTS photos (photo_id serial PRIMARY KEY, value text NOT NULL, caption text);',
+        '''
+        CREATE TABLE IF NOT EXISTS updates (
+            update_id bigint PRIMARY KEY,
+            type text NOT NULL,
+            user_id uuid NOT NULL REFERENCES users,
+            value_id integer,
+            responded boolean NOT NULL DEFAULT FALSE
+        );
+        ''',
+    ]),
+    (2, 'indexes for hot path queries', [
+        'CREATE UNIQUE INDEX IF NOT EXISTS users_chat_id ON users (chat_id);',
+        # updates table made by hand can lack primary key, update_id is looked up by it
+        '''
+        DO $$
+        BEGIN
+            IF NOT EXISTS (SELECT 1 FROM pg_constraint WHERE conrelid = 'updates'::regclass AND contype = 'p') THEN
+                ALTER TABLE updates ADD PRIMARY KEY (update_id);
+            END IF;
+        END
+        $$;
+        ''',
+        # ordering: earlier updates of user that are not responded yet
+        'CREATE INDEX IF NOT EXISTS updates_not_responded ON updates (user_id, update_id) WHERE NOT responded;',
+        # conversation state rebuild: last command of user and updates after it
+        'CREATE INDEX IF NOT EXISTS updates_user_type ON updates (user_id, type, update_id);',
+        'CREATE INDEX IF NOT EXISTS updates_user ON updates (user_id, update_id);',
+        'CREATE INDEX IF NOT EXISTS families_child_id ON families (child_id);',
+    ]),
+    (3, 'conversation state, users cache notifications', [
+        # Conversation state of users (see state.StateStore)
+        '''
+        CREATE TABLE IF NOT EXISTS user_state (
+            user_id uuid PRIMARY KEY,
+            command text,
+            step integer NOT NULL DEFAULT 0,
+            update_id bigint NOT NULL DEFAULT 0
+        );
+        ''',
+        "ALTER TABLE user_state ADD COLUMN IF NOT EXISTS answers text[] NOT NULL DEFAULT '{}';",
+        # Notifications for users cache invalidation and known users (channel users_changed, payload is chat_id)
+        '''
+        CREATE OR REPLACE FUNCTION notify_user_changed() RETURNS trigger
+        LANGUAGE plpgsql AS $$
+        BEGIN
+            IF TG_OP = 'INSERT' THEN
+                PERFORM pg_notify('users_changed', NEW.chat_id::text);
+            ELSE
+                PERFORM pg_notify('users_changed', OLD.chat_id::text);
+            END IF;
+            RETURN NULL;
+        END
+        $$;
+        ''',
+        '''
+        CREATE OR REPLACE FUNCTION notify_family_changed() RETURNS trigger
+        LANGUAGE plpgsql AS $$
+        DECLARE
+            v_family families%ROWTYPE;
+        BEGIN
+            IF TG_OP = 'DELETE' THEN
+                v_family := OLD;
+            ELSE
+                v_family := NEW;
+            END IF;
+            PERFORM pg_notify('users_changed', users.chat_id::text)
+                FROM users WHERE users.user_id IN (v_family.parent_id, v_family.child_id);
+            RETURN NULL;
+        END
+        $$;
+        ''',
+        'DROP TRIGGER IF EXISTS user_changed ON users;',
+        '''
+        CREATE TRIGGER user_changed AFTER INSERT OR UPDATE OR DELETE ON users
+            FOR EACH ROW EXECUTE PROCEDURE notify_user_changed();
+        ''',
+        'DROP TRIGGER IF EXISTS family_changed ON families;',
+        '''
+        CREATE TRIGGER family_changed AFTER INSERT OR UPDATE OR DELETE ON families
+            FOR EACH ROW EXECUTE PROCEDURE notify_family_changed();
+        ''',
+    ]),
+    (4, 'updates partitioned by month, retention functions', [
+        'CREATE SCHEMA IF NOT EXISTS archive;',
+        # existing updates table becomes partition with all rows before current month
+        '''
+        DO $$
+        DECLARE
+            v_name text := 'updates_before_' || to_char(now(), 'YYYYMM');
+            v_index text;
+        BEGIN
+            EXECUTE format('ALTER TABLE updates RENAME TO %I', v_name);
+            FOREACH v_index IN ARRAY ARRAY['pkey', 'update_id', 'not_responded', 'user_type', 'user'] LOOP
+                EXECUTE format('ALTER INDEX IF EXISTS %I RENAME TO %I',
+                               'updates_' || v_index, v_name || '_' || v_index);
+            END LOOP;
+            EXECUTE format('ALTER TABLE %I ADD COLUMN IF NOT EXISTS created_at timestamptz NOT NULL DEFAULT %L',
+                           v_name, '-infinity');
+            -- created_at of table made by hand can be nullable, partition key column must be NOT NULL
+            EXECUTE format('UPDATE %I SET created_at = %L WHERE created_at IS NULL', v_name, '-infinity');
+            EXECUTE format('ALTER TABLE %I ALTER COLUMN created_at SET NOT NULL', v_name);
+            CREATE TABLE updates (
+                update_id bigint NOT NULL,
+                type text NOT NULL,
+                user_id uuid NOT NULL REFERENCES users,
+                value_id integer,
+                responded boolean NOT NULL DEFAULT FALSE,
+                created_at timestamptz NOT NULL DEFAULT now()
+            ) PARTITION BY RANGE (created_at);
+            EXECUTE format('ALTER TABLE updates ATTACH PARTITION %I FOR VALUES FROM (MINVALUE) TO (%L)',
+                           v_name, date_trunc('month', now()));
+        END
+        $$;
+        ''',
+        # update_id can't be unique in partitioned table, repeating updates are found by processed_updates
+        'CREATE INDEX updates_update_id ON updates (update_id);',
+        'CREATE INDEX updates_not_responded ON updates (user_id, update_id) WHERE NOT responded;',
+        'CREATE INDEX updates_user_type ON updates (user_id, type, update_id);',
+        'CREATE INDEX updates_user ON updates (user_id, update_id);',
+        # partition updates_YYYYMM for month of p_month. Rows of the month saved to default partition
+        # (partition wasn't made in time) are moved to it, else partition can't be created
+        '''
+        CREATE OR REPLACE FUNCTION create_updates_partition(p_month date) RETURNS text
+        LANGUAGE plpgsql AS $$
+        DECLARE
+            v_name text := 'updates_' || to_char(p_month, 'YYYYMM');
+            v_from timestamptz := date_trunc('month', p_month);
+            v_to timestamptz := date_trunc('month', p_month) + interval '1 month';
+        BEGIN
+            IF to_regclass(v_name) IS NOT NULL THEN
+                RETURN v_name;
+            END IF;
+            IF EXISTS (SELECT 1 FROM updates_default WHERE created_at >= v_from AND created_at < v_to) THEN
+                EXECUTE format('CREATE TABLE %I (LIKE updates INCLUDING DEFAULTS INCLUDING CONSTRAINTS)', v_name);
+                EXECUTE format('WITH moved AS (DELETE FROM updates_default '
+                               'WHERE created_at >= %L AND created_at < %L RETURNING *) '
+                               'INSERT INTO %I SELECT * FROM moved',
+                               v_from, v_to, v_name);
+                EXECUTE format('ALTER TABLE updates ATTACH PARTITION %I FOR VALUES FROM (%L) TO (%L)',
+                               v_name, v_from, v_to);
+            ELSE
+                EXECUTE format('CREATE TABLE %I PARTITION OF updates FOR VALUES FROM (%L) TO (%L)',
+                               v_name, v_from, v_to);
+            END IF;
+            RETURN v_name;
+        END
+        $$;
+        ''',
+        'CREATE TABLE updates_default PARTITION OF updates DEFAULT;',   # if retention worker didn't run in time
+        'SELECT create_updates_partition(now()::date);',
+        "SELECT create_updates_partition((now() + interval '1 month')::date);",
+        # Detaching holds ACCESS EXCLUSIVE lock of updates, so it is a transaction of its own
+        # and gives up instead of queueing ingestion behind it for long
+        '''
+        CREATE OR REPLACE FUNCTION detach_updates_partition(p_partition text) RETURNS void
+        LANGUAGE plpgsql SET lock_timeout = '1s' AS $$
+        BEGIN
+            EXECUTE format('ALTER TABLE updates DETACH PARTITION %I', p_partition);
+        END
+        $$;
+        ''',
+        # Moving detached partition of updates with its data rows to archive schema (or dropping them)
+        '''
+        CREATE OR REPLACE FUNCTION archive_updates_partition(p_partition text, p_drop boolean) RETURNS void
+        LANGUAGE plpgsql AS $$
+        DECLARE
+            v_data record;
+        BEGIN
+            FOR v_data IN SELECT * FROM (VALUES ('command', 'commands', 'command_id'),
+                                                ('text', 'texts', 'text_id'),
+                                                ('audio', 'audios', 'audio_id'),
+                                                ('video', 'videos', 'video_id'),
+                                                ('document', 'documents', 'document_id'),
+                                                ('photo', 'photos', 'photo_id')) AS data_tables (type, name, id) LOOP
+                IF p_drop THEN
+                    EXECUTE format('DELETE FROM public.%I WHERE %I IN (SELECT value_id FROM %I WHERE type = %L)',
+                                   v_data.name, v_data.id, p_partition, v_data.type);
+                ELSE
+                    EXECUTE format('CREATE TABLE IF NOT EXISTS archive.%I (LIKE public.%I)', v_data.name, v_data.name);
+                    EXECUTE format('WITH moved AS (DELETE FROM public.%I '
+                                   'WHERE %I IN (SELECT value_id FROM %I WHERE type = %L) RETURNING *) '
+                                   'INSERT INTO archive.%I SELECT * FROM moved',
+                                   v_data.name, v_data.id, p_partition, v_data.type, v_data.name);
+                END IF;
+            END LOOP;
+            IF p_drop THEN
+                EXECUTE format('DROP TABLE %I', p_partition);
+            ELSE
+                EXECUTE format('ALTER TABLE %I SET SCHEMA archive', p_partition);
+            END IF;
+        END
+        $$;
+        ''',
+    ]),
+    (5, 'lessons and reminders', [
+        '''
+        CREATE TABLE IF NOT EXISTS lessons (
+            lesson_id serial PRIMARY KEY,
+            tutor_id uuid NOT NULL REFERENCES users,
+            starts_at timestamptz NOT NULL,
+            cancelled boolean NOT NULL DEFAULT FALSE,
+            reminded_for timestamptz    -- starts_at of the lesson the reminder was sent for
+        );
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS lesson_students (
+            lesson_id integer NOT NULL REFERENCES lessons ON DELETE CASCADE,
+            student_id uuid NOT NULL REFERENCES users,
+            PRIMARY KEY (lesson_id, student_id)
+        );
+        ''',
+        'CREATE INDEX IF NOT EXISTS lessons_upcoming ON lessons (starts_at) WHERE NOT cancelled;',
+        # Notifications for reminders scheduler (channel lessons_changed, payload is lesson_id)
+        '''
+        CREATE OR REPLACE FUNCTION notify_lesson_changed() RETURNS trigger
+        LANGUAGE plpgsql AS $$
+        BEGIN
+            IF TG_OP = 'DELETE' THEN
+                PERFORM pg_notify('lessons_changed', OLD.lesson_id::text);
+            ELSE
+                PERFORM pg_notify('lessons_changed', NEW.lesson_id::text);
+            END IF;
+            RETURN NULL;
+        END
+        $$;
+        ''',
+        'DROP TRIGGER IF EXISTS lesson_changed ON lessons;',
+        '''
+        CREATE TRIGGER lesson_changed AFTER INSERT OR DELETE OR UPDATE OF starts_at, cancelled ON lessons
+            FOR EACH ROW EXECUTE PROCEDURE notify_lesson_changed();
+        ''',
+    ]),
+    (6, 'broadcasts', [
+        '''
+        CREATE TABLE IF NOT EXISTS broadcasts (
+            broadcast_id serial PRIMARY KEY,
+            author_id uuid REFERENCES users,
+            text text,
+            file_type text,     -- photo, document or NULL for text message
+            file_id text,
+            audience text NOT NULL,
+            audience_id text,
+            created_at timestamptz NOT NULL DEFAULT now(),
+            finished_at timestamptz
+        );
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS broadcast_recipients (
+            broadcast_id integer NOT NULL REFERENCES broadcasts ON DELETE CASCADE,
+            chat_id bigint NOT NULL,
+            status text NOT NULL DEFAULT 'pending',     -- pending or queued (written to outbox)
+            claimed_at timestamptz,
+            PRIMARY KEY (broadcast_id, chat_id)
+        );
+        ''',
+        '''
+        CREATE INDEX IF NOT EXISTS broadcast_recipients_unsent ON broadcast_recipients (broadcast_id, chat_id)
+            WHERE status = 'pending';
+        ''',
+        'CREATE INDEX IF NOT EXISTS broadcasts_unfinished ON broadcasts (broadcast_id) WHERE finished_at IS NULL;',
+        'CREATE INDEX IF NOT EXISTS users_role ON users (role);',
+        # Broadcast with recipients of audience (students, family of parent p_audience_id or lesson p_audience_id)
+        '''
+        CREATE OR REPLACE FUNCTION create_broadcast(p_author_id uuid,
+                                                    p_text text,
+                                                    p_file_type text,
+                                                    p_file_id text,
+                                                    p_audience text,
+                                                    p_audience_id text)
+        RETURNS integer
+        LANGUAGE plpgsql AS $$
+        DECLARE
+            v_broadcast_id integer;
+        BEGIN
+            INSERT INTO broadcasts (author_id, text, file_type, file_id, audience, audience_id)
+                VALUES (p_author_id, p_text, p_file_type, p_file_id, p_audience, p_audience_id)
+                RETURNING broadcast_id INTO v_broadcast_id;
+            IF p_audience = 'students' THEN
+                INSERT INTO broadcast_recipients (broadcast_id, chat_id)
+                    SELECT v_broadcast_id, chat_id FROM users WHERE role = 'student'
+                    ON CONFLICT DO NOTHING;
+            ELSIF p_audience = 'family' THEN
+                INSERT INTO broadcast_recipients (broadcast_id, chat_id)
+                    SELECT v_broadcast_id, users.chat_id FROM users
+                    WHERE users.user_id = p_audience_id::uuid
+                       OR users.user_id IN (SELECT child_id FROM families WHERE parent_id = p_audience_id::uuid)
+                    ON CONFLICT DO NOTHING;
+            ELSIF p_audience = 'lesson' THEN
+                INSERT INTO broadcast_recipients (broadcast_id, chat_id)
+                    SELECT v_broadcast_id, users.chat_id FROM lesson_students
+                    JOIN users ON users.user_id = lesson_students.student_id
+                    WHERE lesson_students.lesson_id = p_audience_id::integer
+                    ON CONFLICT DO NOTHING;
+            ELSE
+                RAISE EXCEPTION 'Unknown audience %', p_audience;
+            END IF;
+            PERFORM pg_notify('broadcasts_added', v_broadcast_id::text);    -- sending starts at commit
+            RETURN v_broadcast_id;
+        END
+        $$;
+        ''',
+    ]),
+    (7, 'media registry', [
+        # One row per file, file_id is the last one received (it can change, file_unique_id can't)
+        '''
+        CREATE TABLE IF NOT EXISTS media (
+            media_id serial PRIMARY KEY,
+            file_unique_id text NOT NULL UNIQUE,
+            file_id text NOT NULL,
+            type text NOT NULL,
+            file_size bigint,
+            mime_type text
+        );
+        ''',
+        # media updates refer to media row instead of photos, videos, documents and audios rows
+        'ALTER TABLE updates ADD COLUMN IF NOT EXISTS media_id integer;',
+        'ALTER TABLE updates ADD COLUMN IF NOT EXISTS caption text;',
+    ]),
+    (8, 'outbox of replies', [
+        '''
+        CREATE TABLE IF NOT EXISTS outbox (
+            outbox_id bigserial PRIMARY KEY,
+            chat_id bigint NOT NULL,
+            method text NOT NULL,   -- Bot API method: SendMessage, SendPhoto...
+            payload jsonb NOT NULL,
+            update_id bigint,   -- responded update
+            priority smallint NOT NULL DEFAULT 0,   -- dispatcher priority: 0 interactive, 1 bulk
+            status text NOT NULL DEFAULT 'pending',     -- pending, sending, sent, rejected or failed
+            created_at timestamptz NOT NULL DEFAULT now(),
+            claimed_at timestamptz
+        );
+        ''',
+        # interactive replies are claimed before queued broadcasts and reminders
+        '''
+        CREATE INDEX IF NOT EXISTS outbox_undelivered ON outbox (priority, outbox_id)
+            WHERE status IN ('pending', 'sending');
+        ''',
+        'CREATE INDEX IF NOT EXISTS outbox_created_at ON outbox (created_at);',
+        '''
+        CREATE OR REPLACE FUNCTION notify_outbox_added() RETURNS trigger
+        LANGUAGE plpgsql AS $$
+        BEGIN
+            PERFORM pg_notify('outbox_added', '');
+            RETURN NULL;
+        END
+        $$;
+        ''',
+        'DROP TRIGGER IF EXISTS outbox_added ON outbox;',
+        '''
+        CREATE TRIGGER outbox_added AFTER INSERT ON outbox
+            FOR EACH STATEMENT EXECUTE PROCEDURE notify_outbox_added();
+        ''',
+    ]),
+    (9, 'processed updates', [
+        # update_id can't be unique in updates partitioned by created_at, so this table deduplicates updates.
+        # Telegram doesn't repeat updates older than 24 hours, old rows are deleted by retention worker
+        '''
+        CREATE TABLE IF NOT EXISTS processed_updates (
+            update_id bigint PRIMARY KEY,
+            created_at timestamptz NOT NULL DEFAULT now()
+        );
+        ''',
+        'CREATE INDEX IF NOT EXISTS processed_updates_created_at ON processed_updates (created_at);',
+        "INSERT INTO processed_updates (update_id) SELECT update_id FROM updates "
+        "WHERE created_at > now() - interval '2 days' ON CONFLICT DO NOTHING;",
+    ]),
+    (10, 'update ingestion functions', [
+        # Deduplication (processed_updates key) and data saving for update of known user.
+        # Returns media_id as value_id for media updates, no rows for repeating update.
+        # p_media_id is media_id of file found in MediaRegistry of process, NULL for unknown file
+        '''
+        CREATE OR REPLACE FUNCTION save_update(p_update_id bigint,
+                                               p_user_id uuid,
+                                               p_type text,
+                                               p_value text,
+                                               p_caption text,
+                                               p_file_unique_id text,
+                                               p_file_size bigint,
+                                               p_mime_type text,
+                                               p_media_id integer)
+        RETURNS TABLE (value_id integer)
+        LANGUAGE plpgsql AS $$
+        DECLARE
+            v_value_id integer;
+        BEGIN
+            INSERT INTO processed_updates (update_id) VALUES (p_update_id) ON CONFLICT DO NOTHING;
+            IF NOT FOUND THEN   -- repeating update, concurrent delivery waits here for the first one
+                RETURN;
+            END IF;
+            IF p_type IN ('command', 'text') THEN
+                EXECUTE format('INSERT INTO %I (value) VALUES ($1) RETURNING %I', p_type || 's', p_type || '_id')
+                    INTO v_value_id USING p_value;
+                INSERT INTO updates (type, user_id, update_id, value_id)
+                    VALUES (p_type, p_user_id, p_update_id, v_value_id);
+            ELSIF p_media_id IS NOT NULL THEN   -- file known to process by the same file_id isn't written
+                v_value_id := p_media_id;
+                INSERT INTO updates (type, user_id, update_id, media_id, caption)
+                    VALUES (p_type, p_user_id, p_update_id, v_value_id, p_caption);
+            ELSE
+                -- known file is written only if its file_id has changed
+                INSERT INTO media (file_unique_id, file_id, type, file_size, mime_type)
+                    VALUES (p_file_unique_id, p_value, p_type, p_file_size, p_mime_type)
+                    ON CONFLICT (file_unique_id) DO UPDATE SET file_id = EXCLUDED.file_id
+                    WHERE media.file_id <> EXCLUDED.file_id
+                    RETURNING media_id INTO v_value_id;
+                IF NOT FOUND THEN
+                    SELECT media_id INTO v_value_id FROM media WHERE file_unique_id = p_file_unique_id;
+                END IF;
+                INSERT INTO updates (type, user_id, update_id, media_id, caption)
+                    VALUES (p_type, p_user_id, p_update_id, v_value_id, p_caption);
+            END IF;
+            value_id := v_value_id;
+            RETURN NEXT;
+        END
+        $$;
+        ''',
+        # Deduplication, user search or registration, relatives loading and data saving for one update.
+        # Returns no rows for repeating update
+        '''
+        CREATE OR REPLACE FUNCTION ingest_update(p_update_id bigint,
+                                                 p_chat_id bigint,
+                                                 p_is_bot boolean,
+                                                 p_type text,
+                                                 p_value text,
+                                                 p_caption text,
+                                                 p_file_unique_id text,
+                                                 p_file_size bigint,
+                                                 p_mime_type text,
+                                                 p_media_id integer)
+        RETURNS TABLE (user_id uuid,
+                       phone text,
+                       name text,
+                       surname text,
+                       role text,
+                       current_client boolean,
+                       relatives uuid[],
+                       value_id integer)
+        LANGUAGE plpgsql AS $$
+        DECLARE
+            v_user users%ROWTYPE;
+            v_value_id integer;
+        BEGIN
+            SELECT * INTO v_user FROM users WHERE users.chat_id = p_chat_id;
+            IF NOT FOUND THEN
+                INSERT INTO users (chat_id) VALUES (p_chat_id) ON CONFLICT DO NOTHING RETURNING * INTO v_user;
+                IF NOT FOUND THEN   -- registered by concurrent update
+                    SELECT * INTO v_user FROM users WHERE users.chat_id = p_chat_id;
+                END IF;
+            END IF;
+            IF NOT p_is_bot THEN
+                SELECT saved.value_id INTO v_value_id
+                    FROM save_update(p_update_id, v_user.user_id, p_type, p_value, p_caption,
+                                     p_file_unique_id, p_file_size, p_mime_type, p_media_id) AS saved;
+                IF NOT FOUND THEN
+                    RETURN;
+                END IF;
+            END IF;
+            user_id := v_user.user_id;
+            phone := v_user.phone;
+            name := v_user.name;
+            surname := v_user.surname;
+            role := v_user.role;
+            current_client := v_user.current_client;
+            relatives := CASE v_user.role
+                WHEN 'parent' THEN ARRAY(SELECT child_id FROM families WHERE parent_id = v_user.user_id)
+                WHEN 'student' THEN ARRAY(SELECT parent_id FROM families WHERE child_id = v_user.user_id)
+                ELSE '{}'::uuid[] END;
+            value_id := v_value_id;
+            RETURN NEXT;
+        END
+        $$;
+        ''',
+    ]),
+]
+
+LOCK_ID = 7318001   # advisory lock taken while migrating, so processes don't migrate concurrently
+
+# Statements inside ingest_update() and save_update() functions with sample arguments for index usage check
+
+FUNCTIONS_STATEMENTS = {
+    'user_by_chat_id': ('SELECT * FROM users WHERE chat_id = $1;', (1,)),
+    'media_by_unique_id': ('SELECT media_id FROM media WHERE file_unique_id = $1;', ('unique_id',)),
+}
+
+
+def _seq_scans(plan: dict) -> list:
+    tables = [plan['Relation Name']] if plan['Node Type'] == 'Seq Scan' else []
+    for subplan in plan.get('Plans', []):
+        tables.extend(_seq_scans(subplan))
+    return tables
+
+
+# Returns {statement name: tables read by sequential scan} for statements that can't use indexes
+async def check_indexes(connection) -> dict:
+    checked = dict(FUNCTIONS_STATEMENTS)
+    checked.update({statement.name: (statement.sql, statement.sample)
+                    for statement in Statement.catalog.values() if statement.sample is not None})
+    problems = {}
+    async with connection.transaction():
+        await connection.execute('SET LOCAL enable_seqscan = off;')   # tables of test database are small
+        for name, (statement, args) in checked.items():
+            plan = await connection.fetchval(f'EXPLAIN (FORMAT JSON) {statement}', *args)
+            tables = _seq_scans(json.loads(plan)[0]['Plan'])
+            if tables:
+                problems[name] = tables
+    return problems
+
+
+if __name__ == '__main__':     # python schema.py: migration and index usage check using config.ini
+    from customconfigparser import CustomConfigParser
+    from database import Database
+    from pathlib import Path
+    import asyncio
+
+    async def main():
+        config = CustomConfigParser()
+        config.read(Path.cwd() / 'config.ini')
+        database = Database(config=config)
+        await database.create_pool_if_not_exist()
+        async with database.pool.acquire() as connection:
+            problems = await check_indexes(connection)
+        for name, tables in problems.items():
+            print(f'{name}: sequential scan of {", ".join(tables)}')
+        if not problems:
+            print('All hot path statements use indexes')
+        await database.pool.close()
+
+    asyncio.run(main())
@@ -0,0 +1,68 @@
+from customconfigparser import CustomConfigParser
+import bisect
+import asyncio
+
+"""
+In-process ordering of updates per chat
+Each update waits until all earlier updates of the same chat are handled,
+its turn is given by the future that done() of the predecessor resolves.
+When more than max_pending updates of chat are pending, the oldest one is dropped from the window
+(it isn't waited for anymore), so a stuck update holds the chat for max_pending updates at most
+"""
+
+
+class Sequencer:
+    def __init__(self,
+                 reorder_window: float = None,
+                 max_pending: int = None,
+                 config: CustomConfigParser = None):
+
+        if reorder_window is None:
+            self.__reorder_window = float(config.get('Bot', 'reorder_window'))
+        else:
+            self.__reorder_window = reorder_window
+        if not max_pending:
+            self.__max_pending = int(config.get('Bot', 'max_pending_updates'))
+        else:
+            self.__max_pending = max_pending
+        self.__pending = {}     # chat_id: sorted list of update_id not handled yet
+        self.__turns = {}   # (chat_id, update_id): future resolved when it's update's turn
+
+    @property
+    def reorder_window(self) -> float:
+        return self.__reorder_window
+
+    @property
+    def max_pending(self) -> int:
+        return self.__max_pending
+
+    # Must be called in order of updates acceptance, before wait()
+    def register(self, chat_id: int, update_id: int):
+        pending = self.__pending.setdefault(chat_id, [])
+        bisect.insort(pending, update_id)
+        self.__turns[(chat_id, update_id)] = asyncio.get_event_loop().create_future()
+        if len(pending) > self.max_pending:     # window is full, the oldest update isn't waited for anymore
+            self.__give_turn(chat_id, pending.pop(0))
+            self.__give_turn(chat_id, pending[0])
+
+    def __give_turn(self, chat_id: int, update_id: int):
+        turn = self.__turns.get((chat_id, update_id))
+        if turn and not turn.done():
+            turn.set_result(True)
+
+    async def wait(self, chat_id: int, update_id: int):
+        await asyncio.sleep(self.reorder_window)    # waiting for earlier updates delivered late
+        pending = self.__pending.get(chat_id)
+        if pending and pending[0] != update_id:     # turn of dropped update is already given
+            await self.__turns[(chat_id, update_id)]
+
+    def done(self, chat_id: int, update_id: int):
+        self.__turns.pop((chat_id, update_id), None)
+        pending = self.__pending.get(chat_id)
+        if not pending or update_id not in pending:     # dropped from full window
+            return
+        pending.remove(update_id)
+        if pending:
+            self.__give_turn(chat_id, pending[0])
+        else:
+            del self.__pending[chat_id]
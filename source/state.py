@@ -0,0 +1,124 @@
+from customconfigparser import CustomConfigParser
+from collections import OrderedDict
+from data import Update, Data, Command
+import asyncpg
+import statements
+
+
+# Commands with forms: answers collected by form (registration: role, name, surname, phone)
+FORMS = {'/register': 4}
+
+
+# Answers are kept only while form of command is filled, so state row doesn't grow outside forms
+def form_answers(command: str, step: int, answers: tuple) -> tuple:
+    return tuple(answers) if step <= FORMS.get(command, 0) else ()
+
+
+# Current command of conversation, number of updates received after it and their values (form answers)
+
+class ConversationState:
+    def __init__(self, command: str = None, step: int = 0, update_id: int = 0, answers: tuple = ()):
+        self.__command = command
+        self.__step = step
+        self.__update_id = update_id    # last update applied to state
+        self.__answers = tuple(answers)
+
+    @property
+    def command(self) -> str:
+        return self.__command
+
+    @property
+    def step(self) -> int:
+        return self.__step
+
+    @property
+    def update_id(self) -> int:
+        return self.__update_id
+
+    @property
+    def answers(self) -> tuple:
+        return self.__answers
+
+    def next(self, data: Data, update_id: int):
+        if isinstance(data, Command) and data.value.startswith('/'):    # new command starts conversation
+            return ConversationState(data.value, 0, update_id)
+        return ConversationState(self.command,
+                                 self.step + 1,
+                                 update_id,
+                                 form_answers(self.command, self.step + 1, self.answers + (data.value,)))
+
+    def __repr__(self):
+        return f'ConversationState({self.command}, {self.step}, {self.update_id}, {self.answers})'
+
+
+"""
+Conversations states of users by user_id
+Held in memory (LRU), written through to user_state table,
+rebuilt from updates table if there is no row for user
+"""
+
+
+class StateStore:
+    def __init__(self, size: int = None, config: CustomConfigParser = None):
+        if not size:
+            self.__size = int(config.get('Cache', 'state_cache_size'))
+        else:
+            self.__size = size
+        self.__states = OrderedDict()   # user_id: ConversationState
+
+    @property
+    def size(self) -> int:
+        return self.__size
+
+    async def get(self, connection: asyncpg.connection.Connection, update: Update) -> ConversationState:
+        state = self.__states.get(update.user.user_id)
+        if state is None:
+            state = await self.__load(connection, update)
+            self.__remember(update.user.user_id, state)
+        else:
+            self.__states.move_to_end(update.user.user_id)
+        return state
+
+    async def __load(self, connection: asyncpg.connection.Connection, update: Update) -> ConversationState:
+        record = await statements.USER_STATE.fetchrow(connection, update.user.user_id)
+        if record:
+            return ConversationState(record['command'], record['step'], record['update_id'], record['answers'])
+        record = await statements.LAST_COMMAND.fetchrow(connection,
+                                                        update.user.user_id, 'command', update.update_id, '/%')
+        if not record:
+            return ConversationState()
+        result = await statements.VALUES_AFTER_COMMAND.fetch(connection,
+                                                             'text', 'command', 'photo', 'video', 'document', 'audio',
+                                                             update.user.user_id, record['update_id'], update.update_id)
+        answers = [answer['value'] for answer in result]
+        return ConversationState(record['value'],
+                                 len(answers),
+                                 answers=form_answers(record['value'], len(answers), answers))
+
+    def __remember(self, user_id, state: ConversationState):
+        self.__states[user_id] = state
+        self.__states.move_to_end(user_id)
+        while len(self.__states) > self.size:
+            self.__states.popitem(last=False)
+
+    async def set(self, connection: asyncpg.connection.Connection, update: Update, state: ConversationState):
+        self.__remember(update.user.user_id, state)
+        await statements.SET_USER_STATE.execute(connection,
+                                                 update.user.user_id,
+                                                 state.command,
+                                                 state.step,
+                                                 state.update_id,
+                                                 state.answers)
+
+    # State change is rolled back with transaction of update handling
+    def forget(self, user_id):
+        self.__states.pop(user_id, None)
+
+    # Applying update to state of its user, must be called in updates order
+    async def advance(self, connection: asyncpg.connection.Connection, update: Update) -> ConversationState:
+        state = await self.get(connection, update)
+        if state.update_id >= update.update_id:    # already applied
+            return state
+        state = state.next(update.data, update.update_id)
+        await self.set(connection, update, state)
+        return state
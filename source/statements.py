@@ -0,0 +1,366 @@
+import asyncpg
+import contextvars
+import datetime
+import logging
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+# Queries of current update: [count], set in save_update and shared with handle_update task (context is copied)
+QUERIES = contextvars.ContextVar('queries', default=None)
+
+"""
+Catalog of all SQL statements of application
+Statements are prepared once on every pool connection (see Database),
+call sites use methods of Statement objects instead of SQL text.
+Every call is timed: calls, total and max time, rows are kept per statement (see metrics),
+calls slower than slow_query_threshold are logged with types of arguments instead of values
+"""
+
+
+# Rows count of command status: 'UPDATE 3', 'INSERT 0 1'
+
+def affected_rows(status: str) -> int:
+    count = (status or '').rpartition(' ')[2]
+    return int(count) if count.isdigit() else 0
+
+
+class Statement:
+    catalog = {}    # name: Statement
+    slow_query_threshold = None     # seconds, set by Database
+
+    def __init__(self, name: str, sql: str, sample: tuple = None):
+        if name in Statement.catalog:
+            raise ValueError(f'Statement {name} is already in catalog')
+        self.__name = name
+        self.__sql = sql
+        self.__sample = sample  # arguments for EXPLAIN in index usage check (schema.check_indexes)
+        self.__calls = 0
+        self.__total_time = 0
+        self.__max_time = 0
+        self.__rows = 0
+        Statement.catalog[name] = self
+
+    @property
+    def name(self) -> str:
+        return self.__name
+
+    @property
+    def sql(self) -> str:
+        return self.__sql
+
+    @property
+    def sample(self) -> tuple:
+        return self.__sample
+
+    @property
+    def calls(self) -> int:
+        return self.__calls
+
+    @property
+    def total_time(self) -> float:
+        return self.__total_time
+
+    @property
+    def max_time(self) -> float:
+        return self.__max_time
+
+    @property
+    def rows(self) -> int:
+        return self.__rows
+
+    def prepared(self, connection: asyncpg.connection.Connection) -> asyncpg.prepared_stmt.PreparedStatement:
+        return getattr(connection, 'prepared', {}).get(self.name)
+
+    # Parameters are personal data (names, phones, texts), so only their types get to log
+    def __record(self, duration: float, rows: int, args: tuple):
+        self.__calls += 1
+        self.__total_time += duration
+        self.__max_time = max(self.__max_time, duration)
+        self.__rows += rows
+        queries = QUERIES.get()
+        if queries is not None:
+            queries[0] += 1
+        if Statement.slow_query_threshold is not None and duration >= Statement.slow_query_threshold:
+            logger.warning('Slow query %s: %.3f s, %s rows, arguments (%s)', self.name, duration, rows,
+                           ', '.join(type(arg).__name__ for arg in args))
+
+    async def fetch(self, connection: asyncpg.connection.Connection, *args) -> list:
+        started = time.monotonic()
+        prepared = self.prepared(connection)
+        if prepared:
+            records = await prepared.fetch(*args)
+        else:
+            records = await connection.fetch(self.sql, *args)
+        self.__record(time.monotonic() - started, len(records), args)
+        return records
+
+    async def fetchrow(self, connection: asyncpg.connection.Connection, *args) -> asyncpg.Record:
+        started = time.monotonic()
+        prepared = self.prepared(connection)
+        if prepared:
+            record = await prepared.fetchrow(*args)
+        else:
+            record = await connection.fetchrow(self.sql, *args)
+        self.__record(time.monotonic() - started, int(record is not None), args)
+        return record
+
+    async def fetchval(self, connection: asyncpg.connection.Connection, *args):
+        started = time.monotonic()
+        prepared = self.prepared(connection)
+        if prepared:
+            value = await prepared.fetchval(*args)
+        else:
+            value = await connection.fetchval(self.sql, *args)
+        self.__record(time.monotonic() - started, int(value is not None), args)
+        return value
+
+    async def execute(self, connection: asyncpg.connection.Connection, *args):
+        started = time.monotonic()
+        prepared = self.prepared(connection)
+        if prepared:
+            await prepared.fetch(*args)    # prepared statement has no execute()
+            status = prepared.get_statusmsg()
+        else:
+            status = await connection.execute(self.sql, *args)
+        self.__record(time.monotonic() - started, affected_rows(status), args)
+
+    def __repr__(self):
+        return f'Statement({self.name})'
+
+
+# Updates
+
+INGEST_UPDATE = Statement('ingest_update',
+                          'SELECT * FROM ingest_update($1, $2, $3, $4, $5, $6, $7, $8, $9, $10);')
+
+SAVE_UPDATE = Statement('save_update',
+                        'SELECT value_id FROM save_update($1, $2, $3, $4, $5, $6, $7, $8, $9);')
+
+# Bound of created_at lets partitions of previous months be pruned at execution,
+# Telegram doesn't deliver updates older than 24 hours
+RECENT_UPDATES = "created_at > now() - interval '2 days'"
+
+COUNT_UPDATES_NO_RESP = Statement('count_updates_no_resp',
+                                  'SELECT COUNT(*) FROM updates '
+                                  f'WHERE NOT responded AND update_id < $1 AND user_id = $2 AND {RECENT_UPDATES};',
+                                  (1, uuid.uuid4()))
+
+SET_UPDATES_RESPONDED = Statement('set_updates_responded',
+                                  'UPDATE updates SET responded = TRUE '
+                                  f'WHERE NOT responded AND update_id < $1 AND user_id = $2 AND {RECENT_UPDATES};',
+                                  (1, uuid.uuid4()))
+
+SET_RESPONDED = Statement('set_responded',
+                          'WITH responded AS (UPDATE updates SET responded = TRUE '
+                          f'WHERE update_id = $1 AND {RECENT_UPDATES} '
+                          'RETURNING update_id) '
+                          'SELECT pg_notify($2, update_id::text) FROM responded;',
+                          (1, 'responded'))
+
+# Users
+
+REGISTER_USER = Statement('register_user',
+                          'INSERT INTO users (chat_id) VALUES ($1) RETURNING user_id;')
+
+SAVE_PROFILE = Statement('save_profile',
+                         'UPDATE users SET role = $2, name = $3, surname = $4, phone = $5 WHERE user_id = $1;')
+
+# Registered users for admission control (see UserCache.known)
+KNOWN_CHAT_IDS = Statement('known_chat_ids',
+                           'SELECT chat_id FROM users;')
+
+CHILDREN = Statement('children',
+                     'SELECT child_id FROM families WHERE parent_id = $1;',
+                     (uuid.uuid4(),))
+
+PARENTS = Statement('parents',
+                    'SELECT parent_id FROM families WHERE child_id = $1;',
+                    (uuid.uuid4(),))
+
+# Conversation state
+
+USER_STATE = Statement('user_state',
+                       'SELECT command, step, update_id, answers FROM user_state WHERE user_id = $1;',
+                       (uuid.uuid4(),))
+
+SET_USER_STATE = Statement('set_user_state',
+                           'INSERT INTO user_state (user_id, command, step, update_id, answers) '
+                           'VALUES ($1, $2, $3, $4, $5) '
+                           'ON CONFLICT (user_id) DO UPDATE '
+                           'SET command = EXCLUDED.command, step = EXCLUDED.step, '
+                           'update_id = EXCLUDED.update_id, answers = EXCLUDED.answers '
+                           'WHERE user_state.update_id <= EXCLUDED.update_id;',
+                           (uuid.uuid4(), '/help', 0, 1, []))
+
+LAST_COMMAND = Statement('last_command',
+                         'SELECT value, update_id '
+                         'FROM updates JOIN commands ON updates.value_id = commands.command_id '
+                         'WHERE user_id = $1 AND type = $2 AND update_id < $3 '
+                         'AND value LIKE $4 ORDER BY update_id DESC LIMIT 1;',
+                         (uuid.uuid4(), 'command', 1, '/%'))
+
+VALUES_AFTER_COMMAND = Statement('values_after_command',
+                                 'SELECT COALESCE(texts.value, commands.value, media.file_id, photos.value, '
+                                 'videos.value, documents.value, audios.value) AS value '
+                                 'FROM updates '
+                                 'LEFT JOIN media ON media.media_id = updates.media_id '
+                                 'LEFT JOIN texts ON type = $1 AND value_id = text_id '
+                                 'LEFT JOIN commands ON type = $2 AND value_id = command_id '
+                                 'LEFT JOIN photos ON type = $3 AND value_id = photo_id '
+                                 'LEFT JOIN videos ON type = $4 AND value_id = video_id '
+                                 'LEFT JOIN documents ON type = $5 AND value_id = document_id '
+                                 'LEFT JOIN audios ON type = $6 AND value_id = audio_id '
+                                 'WHERE user_id = $7 AND update_id > $8 AND update_id < $9 '
+                                 'ORDER BY update_id;',
+                                 ('text', 'command', 'photo', 'video', 'document', 'audio', uuid.uuid4(), 1, 2))
+
+# Retention of updates partitions
+
+# Session lock, retention steps are separate transactions
+TRY_RETENTION_LOCK = Statement('try_retention_lock',
+                               'SELECT pg_try_advisory_lock($1);')
+
+RETENTION_UNLOCK = Statement('retention_unlock',
+                             'SELECT pg_advisory_unlock($1);')
+
+CREATE_UPDATES_PARTITION = Statement('create_updates_partition',
+                                     'SELECT create_updates_partition($1);')
+
+# Partitions (updates_YYYYMM or updates_before_YYYYMM) with all rows older than $1,
+# attached or left detached by interrupted archiving
+OLD_UPDATES_PARTITIONS = Statement('old_updates_partitions',
+                                   'SELECT child.relname AS name, pg_inherits.inhrelid IS NOT NULL AS attached '
+                                   'FROM pg_class AS child '
+                                   'LEFT JOIN pg_inherits ON pg_inherits.inhrelid = child.oid '
+                                   "WHERE child.relnamespace = 'public'::regnamespace AND child.relkind = 'r' "
+                                   "AND child.relname ~ '^updates_(before_)?[0-9]{6}$' "
+                                   "AND to_date(right(child.relname, 6), 'YYYYMM') + "
+                                   "CASE WHEN child.relname LIKE 'updates\\_before\\_%' "
+                                   "THEN interval '0 months' ELSE interval '1 month' END <= $1 "
+                                   "ORDER BY right(child.relname, 6);")
+
+DETACH_UPDATES_PARTITION = Statement('detach_updates_partition',
+                                     'SELECT detach_updates_partition($1);')
+
+ARCHIVE_UPDATES_PARTITION = Statement('archive_updates_partition',
+                                      'SELECT archive_updates_partition($1, $2);')
+
+DELETE_PROCESSED_UPDATES = Statement('delete_processed_updates',
+                                     'DELETE FROM processed_updates '
+                                     'WHERE created_at < now() - make_interval(hours => $1);',
+                                     (48,))
+
+# Media registry
+
+MEDIA = Statement('media',
+                  'SELECT media_id, file_unique_id, file_id, type FROM media WHERE file_unique_id = $1;',
+                  ('unique_id',))
+
+# Lessons reminders
+
+# Lessons without reminder for current time of start, starting after $1
+UPCOMING_LESSONS = Statement('upcoming_lessons',
+                             'SELECT lesson_id, starts_at FROM lessons '
+                             'WHERE NOT cancelled AND starts_at > $1 '
+                             'AND reminded_for IS DISTINCT FROM starts_at;',
+                             (datetime.datetime(2000, 1, 1, tzinfo=datetime.timezone.utc),))
+
+LESSON = Statement('lesson',
+                   'SELECT lesson_id, starts_at, cancelled, reminded_for FROM lessons WHERE lesson_id = $1;',
+                   (1,))
+
+# Reminder is claimed in transaction writing its messages to outbox, so it is sent by one process only
+# and isn't lost if process dies before sending.
+# Returns chat_id of tutor and students, no rows if lesson was changed or reminder is already claimed
+CLAIM_REMINDER = Statement('claim_reminder',
+                           'WITH claimed AS (UPDATE lessons SET reminded_for = starts_at '
+                           'WHERE lesson_id = $1 AND starts_at = $2 AND NOT cancelled '
+                           'AND reminded_for IS DISTINCT FROM starts_at '
+                           'RETURNING lesson_id, tutor_id) '
+                           'SELECT users.chat_id FROM claimed '
+                           'JOIN lesson_students ON lesson_students.lesson_id = claimed.lesson_id '
+                           'JOIN users ON users.user_id = lesson_students.student_id '
+                           'UNION '
+                           'SELECT users.chat_id FROM claimed JOIN users ON users.user_id = claimed.tutor_id;')
+
+# Broadcasts
+
+CREATE_BROADCAST = Statement('create_broadcast',
+                             'SELECT create_broadcast($1, $2, $3, $4, $5, $6);')
+
+BROADCAST = Statement('broadcast',
+                      'SELECT broadcast_id, text, file_type, file_id FROM broadcasts WHERE broadcast_id = $1;',
+                      (1,))
+
+UNFINISHED_BROADCASTS = Statement('unfinished_broadcasts',
+                                  'SELECT broadcast_id FROM broadcasts WHERE finished_at IS NULL;',
+                                  ())
+
+# Next batch of recipients, several processes can queue one broadcast.
+# Must be called in transaction writing their messages to outbox
+CLAIM_RECIPIENTS = Statement('claim_recipients',
+                             "UPDATE broadcast_recipients SET status = 'queued', claimed_at = now() "
+                             "WHERE broadcast_id = $1 AND chat_id IN ("
+                             "SELECT chat_id FROM broadcast_recipients "
+                             "WHERE broadcast_id = $1 AND status = 'pending' "
+                             "ORDER BY chat_id LIMIT $2 FOR UPDATE SKIP LOCKED) "
+                             "RETURNING chat_id;",
+                             (1, 100))
+
+FINISH_BROADCAST = Statement('finish_broadcast',
+                             'UPDATE broadcasts SET finished_at = now() '
+                             'WHERE broadcast_id = $1 AND finished_at IS NULL AND NOT EXISTS ('
+                             'SELECT 1 FROM broadcast_recipients '
+                             "WHERE broadcast_id = $1 AND status = 'pending');",
+                             (1,))
+
+
+# Notification of other processes: channel, payload
+
+NOTIFY = Statement('notify',
+                   'SELECT pg_notify($1, $2);')
+
+
+# Outbox
+
+INSERT_OUTBOX = Statement('insert_outbox',
+                          'INSERT INTO outbox (chat_id, method, payload, update_id, priority) '
+                          'VALUES ($1, $2, $3, $4, $5);')
+
+# Messages not replying to update in one round trip (broadcast batch)
+INSERT_OUTBOX_MANY = Statement('insert_outbox_many',
+                               'INSERT INTO outbox (chat_id, method, payload, priority) '
+                               'SELECT chat_id, method, payload::jsonb, $4 '
+                               'FROM unnest($1::bigint[], $2::text[], $3::text[]) AS batch (chat_id, method, payload);')
+
+# Next batch of replies of chats of worker process ($2 of $3 workers, chats are sharded as updates)
+CLAIM_OUTBOX = Statement('claim_outbox',
+                         "UPDATE outbox SET status = 'sending', claimed_at = now() "
+                         'WHERE outbox_id IN ('
+                         'SELECT outbox_id FROM outbox '
+                         "WHERE status = 'pending' AND mod(abs(chat_id), $3) = $2 "
+                         'ORDER BY priority, outbox_id LIMIT $1 FOR UPDATE SKIP LOCKED) '
+                         'RETURNING outbox_id, chat_id, method, payload, priority;',
+                         (50, 0, 1))
+
+SET_OUTBOX_STATUS = Statement('set_outbox_status',
+                              'UPDATE outbox SET status = $2 WHERE outbox_id = ANY($1);',
+                              ([1], 'sent'))
+
+RELEASE_OUTBOX = Statement('release_outbox',
+                           "UPDATE outbox SET status = 'pending', claimed_at = NULL "
+                           "WHERE outbox_id = ANY($1) AND status = 'sending';",
+                           ([1],))
+
+RELEASE_STALE_OUTBOX = Statement('release_stale_outbox',
+                                 "UPDATE outbox SET status = 'pending', claimed_at = NULL "
+                                 "WHERE status = 'sending' AND claimed_at < now() - make_interval(secs => $1);",
+                                 (1.0,))
+
+DELETE_DELIVERED_OUTBOX = Statement('delete_delivered_outbox',
+                                    'DELETE FROM outbox '
+                                    "WHERE status IN ('sent', 'rejected', 'failed') "
+                                    'AND created_at < now() - make_interval(hours => $1);',
+                                    (24,))
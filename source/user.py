@@ -1,8 +1,12 @@
 import asyncpg
 import uuid
+import statements
 
 
 class User:
+    role = 'user'
+    __slots__ = ('__chat_id', '__is_bot', '__phone', '__name', '__surname', '__current_client', '__user_id')
+
     def __init__(self,
                  chat_id: int,
                  is_bot: bool,
@@ -49,19 +53,19 @@ class User:
         return self.__user_id
 
     async def register(self, connection: asyncpg.connection.Connection):
-        self.__user_id = uuid.UUID(await connection.fetchval('INSERT INTO users (chat_id) VALUES ($1) '
-                                                             'RETURNING user_id;',
-                                                             self.chat_id))
+        self.__user_id = await statements.REGISTER_USER.fetchval(connection, self.chat_id)
 
-    async def last_command(self, connection: asyncpg.connection.Connection):
-        return await connection.fetchval('SELECT value FROM updates JOIN commands '
-                                         'ON updates.value_id = commands.command_id '
-                                         'WHERE user_id = $1 AND type = $2 ORDER BY update_id DESC LIMIT 1;',
-                                         self.user_id, 'command')
+    # Answers of registration form, users cache must be invalidated after it
+    async def save_profile(self, connection: asyncpg.connection.Connection,
+                           role: str, name: str, surname: str, phone: str):
+        await statements.SAVE_PROFILE.execute(connection, self.user_id, role, name, surname, phone)
 
     async def find_relatives(self, connection: asyncpg.connection.Connection):
         pass
 
+    def set_relatives(self, relatives: list):
+        pass
+
     def __repr__(self):
         return f'User(' \
                f'{self.chat_id}, ' \
@@ -74,6 +78,9 @@ class User:
 
 
 class Parent(User):
+    role = 'parent'
+    __slots__ = ('__children',)
+
     def __init__(self,
                  chat_id: int,
                  is_bot: bool,
@@ -90,9 +97,12 @@ class Parent(User):
         return self.__children
 
     async def find_relatives(self, connection: asyncpg.connection.Connection):
-        res = await connection.fetch('SELECT child_id FROM families WHERE parent_id = $1;', self.user_id)
+        res = await statements.CHILDREN.fetch(connection, self.user_id)
         self.__children = [record['child_id'] for record in res]
 
+    def set_relatives(self, relatives: list):
+        self.__children = list(relatives)
+
     def __repr__(self):
         return f'Parent(' \
                f'{self.chat_id}, ' \
@@ -106,6 +116,9 @@ class Parent(User):
 
 
 class Student(User):
+    role = 'student'
+    __slots__ = ('__parents',)
+
     def __init__(self,
                  chat_id: int,
                  is_bot: bool,
@@ -122,9 +135,12 @@ class Student(User):
         return self.__parents
 
     async def find_relatives(self, connection: asyncpg.connection.Connection):
-        res = await connection.fetch('SELECT parent_id FROM families WHERE child_id = $1;', self.user_id)
+        res = await statements.PARENTS.fetch(connection, self.user_id)
         self.__parents = [record['parent_id'] for record in res]
 
+    def set_relatives(self, relatives: list):
+        self.__parents = list(relatives)
+
     def __repr__(self):
         return f'Student(' \
                f'{self.chat_id}, ' \
@@ -138,6 +154,9 @@ class Student(User):
 
 
 class Tutor(User):
+    role = 'tutor'
+    __slots__ = ()
+
     def __repr__(self):
         return f'Tutor(' \
                f'{self.chat_id}, ' \
@@ -147,3 +166,12 @@ class Tutor(User):
                f'{self.surname}, ' \
                f'{self.current_client}, ' \
                f'{self.user_id})'
+
+
+# User class by role from users table
+
+USER_CLASSES = {user_class.role: user_class for user_class in (Parent, Student, Tutor)}
+
+
+def user_class(role: str) -> type:
+    return USER_CLASSES.get(role, User)
@@ -1,5 +1,6 @@
 from customconfigparser import CustomConfigParser
 from data import Update, Data, Text, Audio, Photo, Video, Document
+from delivery import DeliveryResult, CircuitBreaker, SENT, REJECTED, FAILED, backoff
 import asyncpg
 import asyncio
 import aiohttp
@@ -74,6 +75,9 @@ class SendData(ABC):
         self.__bot_token = config.get('Bot', 'bot_token')
         self.__server_url = config.get('Bot', 'server_url')
         self.__request_attempts = config.get('Bot', 'request_attempts')
+        self.__request_timeout = config.get('Bot', 'request_timeout')
+        self.__backoff_base = config.get('Bot', 'backoff_base')
+        self.__backoff_max = config.get('Bot', 'backoff_max')
 
     @property
     def chat_id(self) -> int:
@@ -91,20 +95,66 @@ class SendData(ABC):
     def server_url(self) -> str:
         return self.__server_url
 
+    @property
+    def method(self) -> str:    # Bot API method
+        return self.__class__.__name__
+
     @property
     def request_attempts(self) -> int:
         return int(self.__request_attempts)
 
-    async def send(self) -> int:
-        async with aiohttp.ClientSession() as session:
-            for attempt in range(self.request_attempts):
-                await asyncio.sleep(1 * attempt)
-                async with session.post(f'{self.server_url}bot{self.bot_token}/{self.__class__.__name__}',
-                                        json=self.dict()
+    @property
+    def request_timeout(self) -> float:
+        return float(self.__request_timeout)
+
+    @property
+    def backoff_base(self) -> float:
+        return float(self.__backoff_base)
+
+    @property
+    def backoff_max(self) -> float:
+        return float(self.__backoff_max)
+
+    # session is the process-wide one from HttpClient, so connections to Bot API are reused,
+    # breaker is shared by all sends of process (retry policy is described in delivery module)
+    async def send(self, session: aiohttp.ClientSession, breaker: CircuitBreaker = None) -> DeliveryResult:
+        status = error_code = description = None
+        for attempt in range(self.request_attempts):
+            if breaker:
+                await breaker.wait()
+            try:
+                async with session.post(f'{self.server_url}bot{self.bot_token}/{self.method}',
+                                        json=self.dict(),
+                                        timeout=aiohttp.ClientTimeout(total=self.request_timeout)
                                         ) as request:
-                    json_answer = await request.json()
-                    if request.status == 200:
-                        return json_answer['ok']
+                    status = request.status
+                    try:
+                        json_answer = await request.json(content_type=None)
+                    except ValueError:  # HTML page of proxy instead of Bot API answer
+                        json_answer = {}
+                    if not isinstance(json_answer, dict):   # None for empty body of 502, 504...
+                        json_answer = {}
+            except (aiohttp.ClientError, asyncio.TimeoutError) as error:
+                status, json_answer = None, {'description': repr(error)}
+            if status == 200 and json_answer.get('ok'):
+                if breaker:
+                    breaker.succeed()
+                return DeliveryResult(SENT, attempt + 1, status, result=json_answer.get('result'))
+            error_code = json_answer.get('error_code', status)
+            description = json_answer.get('description')
+            if status == 429:   # flood control is per bot, so all sends wait
+                delay = float((json_answer.get('parameters') or {}).get('retry_after', 1))
+                if breaker:
+                    breaker.pause(delay)
+            elif status is None or status >= 500:
+                delay = backoff(attempt, self.backoff_base, self.backoff_max)
+                if breaker:
+                    breaker.fail()
+            else:   # bad request, bot blocked by user...
+                return DeliveryResult(REJECTED, attempt + 1, status, error_code, description)
+            if attempt + 1 < self.request_attempts:
+                await asyncio.sleep(delay)
+        return DeliveryResult(FAILED, self.request_attempts, status, error_code, description)
 
     def dict(self) -> dict:
         data_to_send = {'chat_id': self.chat_id, str.lower(self.data.__class__.__name__): self.data.value}
@@ -138,3 +188,19 @@ class SendVideo(SendData):
 class SendDocument(SendData):
     def __init__(self, config: CustomConfigParser, chat_id: int, data: Document, reply_markup: ReplyMarkup = None):
         super().__init__(config, chat_id, data, reply_markup)
+
+
+# Response read from outbox: Bot API method and payload made by dict() of original response
+
+class StoredSendData(SendData):
+    def __init__(self, config: CustomConfigParser, chat_id: int, method: str, payload: dict):
+        super().__init__(config, chat_id, None)
+        self.__method = method
+        self.__payload = payload
+
+    @property
+    def method(self) -> str:
+        return self.__method
+
+    def dict(self) -> dict:
+        return self.__payload
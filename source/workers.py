@@ -0,0 +1,176 @@
+from customconfigparser import CustomConfigParser
+from data import UPDATE_CLASSES
+from aiohttp import web
+import multiprocessing
+import aiohttp
+import logging
+import asyncio
+import json
+import os
+
+logger = logging.getLogger(__name__)
+
+"""
+Multi-process mode
+Front process accepts webhook and forwards every update to worker process chosen by chat_id,
+so ordering and in-memory state of a chat stay in one worker;
+workers listen on unix sockets and are restarted by front process if they die
+"""
+
+
+# Worker of chat (updates without sender go by update_id), the same as mod(abs(chat_id), workers) of outbox claims
+def shard(json_update: dict, workers: int) -> int:
+    for update_class in UPDATE_CLASSES:
+        sender = json_update.get(update_class.key, {}).get('from')
+        if sender:
+            return abs(sender['id']) % workers
+    return abs(json_update['update_id']) % workers
+
+
+def socket_path(socket_dir: str, worker: int) -> str:
+    return os.path.join(socket_dir, f'tutor_platform_worker_{worker}.sock')
+
+
+# Pool sizes of one worker, total connections of all workers (with listener connections) fit in budget
+def pool_sizes(config: CustomConfigParser, workers: int) -> tuple:
+    min_size = int(config.get('Database', 'min_size'))
+    max_size = int(config.get('Database', 'max_size'))
+    if workers > 1:
+        max_size = max(int(config.get('Database', 'max_connections')) // workers - 1, 1)   # 1 for listener
+        min_size = min(min_size, max_size)
+    return min_size, max_size
+
+
+# Global rate and burst of dispatcher of one worker, all workers together send within Bot API limit
+def global_rates(config: CustomConfigParser, workers: int) -> tuple:
+    global_rate = float(config.get('Dispatcher', 'global_rate')) / workers
+    global_burst = max(float(config.get('Dispatcher', 'global_burst')) / workers, 1)
+    return global_rate, global_burst
+
+
+class Supervisor:
+    def __init__(self,
+                 target,
+                 workers: int = None,
+                 socket_dir: str = None,
+                 restart_delay: float = None,
+                 stop_timeout: float = None,
+                 config: CustomConfigParser = None):
+
+        self.__target = target  # target(worker, workers, path) runs worker application
+        if not workers:
+            self.__workers = int(config.get('Workers', 'workers'))
+        else:
+            self.__workers = workers
+        if not socket_dir:
+            self.__socket_dir = config.get('Workers', 'socket_dir')
+        else:
+            self.__socket_dir = socket_dir
+        if not restart_delay:
+            self.__restart_delay = float(config.get('Workers', 'restart_delay'))
+        else:
+            self.__restart_delay = restart_delay
+        if not stop_timeout:
+            self.__stop_timeout = float(config.get('Bot', 'drain_timeout')) + 5
+        else:
+            self.__stop_timeout = stop_timeout
+        self.__context = multiprocessing.get_context('spawn')   # no fork of running event loop
+        self.__processes = [None] * self.__workers
+        self.__sessions = []
+        self.__task = None
+
+    @property
+    def workers(self) -> int:
+        return self.__workers
+
+    @property
+    def socket_dir(self) -> str:
+        return self.__socket_dir
+
+    @property
+    def restart_delay(self) -> float:
+        return self.__restart_delay
+
+    @property
+    def stop_timeout(self) -> float:
+        return self.__stop_timeout
+
+    def __start_worker(self, worker: int):
+        path = socket_path(self.socket_dir, worker)
+        if os.path.exists(path):
+            os.remove(path)
+        process = self.__context.Process(target=self.__target,
+                                         args=(worker, self.workers, path),
+                                         name=f'worker-{worker}')
+        process.start()
+        self.__processes[worker] = process
+        logger.info('Worker %s started (pid %s)', worker, process.pid)
+
+    async def watch(self):
+        while True:
+            await asyncio.sleep(self.restart_delay)
+            for worker, process in enumerate(self.__processes):
+                if not process.is_alive():
+                    logger.error('Worker %s exited with code %s, restarting', worker, process.exitcode)
+                    self.__start_worker(worker)
+
+    # Forwarding update to its worker, 503 makes Telegram repeat update later if worker is unavailable
+    async def forward(self, request: object):
+        body = await request.read()
+        worker = shard(json.loads(body), self.workers)
+        try:
+            async with self.__sessions[worker].post('http://worker/',
+                                                    data=body,
+                                                    headers={'Content-Type': 'application/json'}) as response:
+                return web.Response(status=response.status, body=await response.read(),
+                                    content_type=response.content_type)
+        except aiohttp.ClientError:
+            logger.warning('Worker %s is unavailable', worker)
+            return web.json_response(status=503)
+
+    # GET /metrics/{worker}: metrics of worker process
+    async def forward_metrics(self, request: object):
+        worker = int(request.match_info['worker'])
+        if not 0 <= worker < self.workers:
+            raise web.HTTPNotFound()
+        try:
+            async with self.__sessions[worker].get('http://worker/metrics') as response:
+                return web.Response(status=response.status, text=await response.text(), content_type='text/plain')
+        except aiohttp.ClientError:
+            return web.json_response(status=503)
+
+    async def start(self):
+        for worker in range(self.workers):
+            self.__start_worker(worker)
+        self.__sessions = [aiohttp.ClientSession(connector=aiohttp.UnixConnector(socket_path(self.socket_dir,
+                                                                                             worker)))
+                           for worker in range(self.workers)]
+        self.__task = asyncio.create_task(self.watch())
+
+    # Workers drain their updates on SIGTERM (see controller.drain_updates)
+    async def close(self):
+        if self.__task:
+            self.__task.cancel()
+            await asyncio.gather(self.__task, return_exceptions=True)
+        for session in self.__sessions:
+            await session.close()
+        for process in self.__processes:
+            if process and process.is_alive():
+                process.terminate()
+        loop = asyncio.get_event_loop()
+        for process in self.__processes:
+            if process:
+                await loop.run_in_executor(None, process.join, self.stop_timeout)
+                if process.is_alive():
+                    logger.warning('Worker %s didn\'t stop in %s seconds, killed', process.name, self.stop_timeout)
+                    process.kill()
+
+
+# aiohttp application signals
+
+async def start_supervisor(app):
+    await app['supervisor'].start()
+
+
+async def close_supervisor(app):
+    await app['supervisor'].close()